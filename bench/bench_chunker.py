@@ -0,0 +1,118 @@
+"""Benchmark of bot.split_markdown on multi-megabyte Gemini-style answers.
+
+Times the single-pass splitter against the slicing loop send_long_message used before, which copies the
+rest of the text for every part, and checks every part of the new splitter: within the limit and with
+balanced code fences. Each size is also run as one line without a single newline, the case where cutting
+inside a line must not copy what is left of it. No Telegram or Gemini access is needed.
+
+  python bench/bench_chunker.py --sizes 1 4 16 --output chunker.json
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def legacy_split(text: str, limit: int) -> list[str]:
+    """The pre-split_markdown algorithm, kept here as the baseline."""
+    parts = []
+    while len(text) > 0:
+        if len(text) > limit:
+            part = text[:limit]
+            last_newline = part.rfind('\n')
+            if last_newline != -1:
+                parts.append(part[:last_newline])
+                text = text[last_newline + 1:]
+            else:
+                parts.append(part)
+                text = text[limit:]
+        else:
+            parts.append(text)
+            break
+    return parts
+
+def gemini_like(size: int, rng: random.Random) -> str:
+    """Markdown resembling long Gemini answers: headings, bold/italic prose, lists and code blocks."""
+    words = ('model', 'latency', '*streaming*', '_cache_', '`asyncio`', 'Telegram', 'request', 'answer', 'token', 'queue')
+    blocks, total = [], 0
+    while total < size:
+        kind = rng.random()
+        if kind < 0.2:
+            body = '\n'.join(f"    result_{i} = compute({i}, limit={rng.randrange(1000)})" for i in range(rng.randrange(5, 400)))
+            block = f"```python\n{body}\n```"
+        elif kind < 0.3:
+            block = '\n'.join(f"- **Item {i}:** " + ' '.join(rng.choice(words) for _ in range(12)) for i in range(rng.randrange(3, 30)))
+        elif kind < 0.35:
+            block = ' '.join(rng.choice(words) for _ in range(rng.randrange(800, 2000)))  # one very long line
+        else:
+            block = f"**Section {len(blocks)}**\n" + ' '.join(rng.choice(words) for _ in range(rng.randrange(40, 200)))
+        blocks.append(block)
+        total += len(block) + 2
+    return '\n\n'.join(blocks)
+
+def single_line(size: int, rng: random.Random) -> str:
+    """Prose with no newline at all, as Gemini sometimes produces for very long answers."""
+    words = ('model', 'latency', '*streaming*', '_cache_', 'Telegram', 'request', 'answer', 'token', 'queue')
+    return ' '.join(rng.choice(words) for _ in range(size // 7))
+
+def check(parts: list[str], limit: int):
+    for part in parts:
+        assert len(part) <= limit, f"part of {len(part)} chars exceeds {limit}"
+        fences = sum(line.lstrip().startswith('```') for line in part.split('\n'))
+        assert fences % 2 == 0, "part leaves a code block open"
+
+def timed(split, text: str, limit: int, repeat: int) -> tuple[float, list[str]]:
+    best, parts = float('inf'), []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        parts = split(text, limit)
+        best = min(best, time.perf_counter() - started)
+    return best, parts
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--sizes', type=float, nargs='+', default=[1, 4, 16], help="answer sizes in MB")
+    parser.add_argument('--limit', type=int, default=None, help="characters per message (default MAX_MESSAGE_LENGTH)")
+    parser.add_argument('--repeat', type=int, default=3, help="runs per size; the fastest is reported")
+    parser.add_argument('--skip-legacy', action='store_true', help="don't time the old quadratic splitter")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help="write results as JSON to this file")
+    args = parser.parse_args()
+
+    os.environ.setdefault('GEMINI_API_KEY', 'bench')
+    sys.path.insert(0, ROOT)
+    import bot
+    limit = args.limit or bot.MAX_MESSAGE_LENGTH
+    rng = random.Random(args.seed)
+    results = []
+    for size_mb in args.sizes:
+        text = gemini_like(int(size_mb * 1024 * 1024), rng)
+        elapsed, parts = timed(bot.split_markdown, text, limit, args.repeat)
+        check(parts, limit)
+        result = {'size_mb': size_mb, 'parts': len(parts), 'split_markdown_s': round(elapsed, 4),
+                  'split_markdown_mb_per_s': round(size_mb / elapsed, 1)}
+        line = f"{size_mb:>6} MB: split_markdown {elapsed * 1000:8.1f} ms ({result['split_markdown_mb_per_s']} MB/s, {len(parts)} parts)"
+        if not args.skip_legacy:
+            legacy, legacy_parts = timed(legacy_split, text, limit, args.repeat)
+            result.update({'legacy_s': round(legacy, 4), 'legacy_parts': len(legacy_parts), 'speedup': round(legacy / elapsed, 2)})
+            line += f", legacy {legacy * 1000:8.1f} ms ({result['speedup']}x)"
+        text = single_line(int(size_mb * 1024 * 1024), rng)
+        elapsed, parts = timed(bot.split_markdown, text, limit, args.repeat)
+        check(parts, limit)
+        result.update({'single_line_s': round(elapsed, 4), 'single_line_parts': len(parts)})
+        line += f"; one line {elapsed * 1000:8.1f} ms"
+        if not args.skip_legacy:
+            legacy, _ = timed(legacy_split, text, limit, args.repeat)
+            result.update({'single_line_legacy_s': round(legacy, 4), 'single_line_speedup': round(legacy / elapsed, 2)})
+            line += f", legacy {legacy * 1000:8.1f} ms ({result['single_line_speedup']}x)"
+        print(line)
+        results.append(result)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump({'limit': limit, 'seed': args.seed, 'results': results}, f, indent=2)
+
+if __name__ == '__main__':
+    main()
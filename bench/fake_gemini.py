@@ -0,0 +1,71 @@
+"""In-process stand-in for genai.GenerativeModel used by the benchmarks.
+
+The real SDK talks gRPC, so instead of a network fake this object replaces `bot.gemini_client.model`.
+Latency is lognormal around a configurable median, and a share of calls can fail with a 503 or come back
+safety-blocked (no parts), which exercises the same retry and fallback paths as production.
+"""
+import math
+import random
+import asyncio
+from types import SimpleNamespace
+
+from google.api_core import exceptions as google_exceptions
+
+WORDS = ('gemini', 'telegram', 'latency', 'cache', 'stream', 'python', 'asyncio', 'answer', 'question', 'model',
+         'token', 'queue', 'request', 'update', 'group', 'private', 'message', 'history', 'budget', 'retry')
+
+class FakeResponse:
+    def __init__(self, text: str, prompt_tokens: int):
+        self.parts = [SimpleNamespace(text=text)] if text else []
+        self._text = text
+        self.usage_metadata = SimpleNamespace(prompt_token_count=prompt_tokens, candidates_token_count=len(text) // 4,
+                                              total_token_count=prompt_tokens + len(text) // 4)
+    @property
+    def text(self) -> str:
+        if not self.parts: raise ValueError("The response was blocked by safety filters.")
+        return self._text
+
+class FakeGeminiModel:
+    def __init__(self, latency_ms: float = 800, sigma: float = 0.5, error_rate: float = 0.0, safety_rate: float = 0.0,
+                 answer_chars: int = 1200, chunks: int = 8, seed: int | None = None):
+        self.median, self.sigma = latency_ms / 1000, sigma
+        self.error_rate, self.safety_rate = error_rate, safety_rate
+        self.answer_chars, self.chunks = answer_chars, max(1, chunks)
+        self.random = random.Random(seed)
+        self.calls = self.errors = self.blocked = 0
+    def _latency(self) -> float: return self.random.lognormvariate(math.log(self.median), self.sigma) if self.median > 0 else 0.0
+    def _answer(self) -> str:
+        lines, size = [], 0
+        while size < self.answer_chars:
+            line = ' '.join(self.random.choice(WORDS) for _ in range(12)).capitalize() + '.'
+            if len(lines) % 6 == 0: line = f"**{line[:30]}**"
+            lines.append(line)
+            size += len(line) + 1
+        return '\n'.join(lines)[:self.answer_chars]
+    def _outcome(self) -> str:
+        roll = self.random.random()
+        if roll < self.error_rate: return 'error'
+        return 'blocked' if roll < self.error_rate + self.safety_rate else 'ok'
+    async def generate_content_async(self, contents, stream: bool = False, request_options: dict | None = None):
+        self.calls += 1
+        prompt_tokens = len(str(contents)) // 4
+        outcome, latency = self._outcome(), self._latency()
+        if outcome == 'error':
+            self.errors += 1
+            await asyncio.sleep(latency * 0.2)
+            raise google_exceptions.ServiceUnavailable("fake backend overloaded")
+        if outcome == 'blocked': self.blocked += 1
+        text = self._answer() if outcome == 'ok' else ''
+        if not stream:
+            await asyncio.sleep(latency)
+            return FakeResponse(text, prompt_tokens)
+        return self._stream(text, prompt_tokens, latency)
+    async def _stream(self, text: str, prompt_tokens: int, latency: float):
+        await asyncio.sleep(latency * 0.3)  # time to first token
+        if not text:
+            yield FakeResponse('', prompt_tokens)
+            return
+        step = math.ceil(len(text) / self.chunks)
+        for start in range(0, len(text), step):
+            if start: await asyncio.sleep(latency * 0.7 / self.chunks)
+            yield FakeResponse(text[start:start + step], prompt_tokens)
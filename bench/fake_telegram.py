@@ -0,0 +1,63 @@
+"""Stand-in Telegram Bot API server for offline benchmarks.
+
+Implements the handful of Bot API methods bot.py calls (getMe, sendMessage, editMessageText,
+deleteMessage, sendChatAction, ...) on top of bot.HttpServer and counts every call. Point the Application at it with
+`bot.build_application(token, base_url=server.base_url)`.
+"""
+import json
+import time
+import asyncio
+import random
+import itertools
+from collections import Counter
+from urllib.parse import parse_qs
+
+from bot import HttpServer
+
+BOT_USER = {'id': 1000000001, 'is_bot': True, 'first_name': 'GemBot', 'username': 'gembot_bench_bot',
+            'can_join_groups': True, 'can_read_all_group_messages': False, 'supports_inline_queries': False}
+
+class FakeTelegramServer:
+    def __init__(self, token: str, host: str = '127.0.0.1', port: int = 0, latency: float = 0.0, flood_rate: float = 0.0, seed: int | None = None):
+        self.token, self.latency, self.flood_rate = token, latency, flood_rate
+        self.random = random.Random(seed)
+        self.http = HttpServer(host, port)
+        self.calls = Counter()
+        self.floods = 0
+        self._message_ids = itertools.count(1)
+        methods = {'getMe': self._get_me, 'sendMessage': self._message, 'editMessageText': self._message,
+                   'deleteMessage': self._true, 'sendChatAction': self._true, 'answerCallbackQuery': self._true,
+                   'leaveChat': self._true, 'setWebhook': self._true, 'deleteWebhook': self._true, 'getUpdates': self._no_updates}
+        for method, handler in methods.items():
+            self.http.route('POST', f'/bot{token}/{method}', self._endpoint(method, handler))
+    @property
+    def base_url(self) -> str:
+        host, port = self.http.server.sockets[0].getsockname()[:2]
+        return f'http://{host}:{port}/bot'
+    async def start(self): await self.http.start()
+    async def stop(self): await self.http.stop()
+    @staticmethod
+    def _params(headers: dict, body: bytes) -> dict:
+        if not body: return {}
+        if headers.get('content-type', '').startswith('application/json'): return json.loads(body)
+        return {key: values[0] for key, values in parse_qs(body.decode('utf-8')).items()}
+    def _endpoint(self, method: str, handler):
+        async def endpoint(headers: dict, body: bytes):
+            if self.latency: await asyncio.sleep(self.latency)
+            self.calls[method] += 1
+            if method in ('sendMessage', 'editMessageText') and self.random.random() < self.flood_rate:
+                self.floods += 1
+                payload = {'ok': False, 'error_code': 429, 'description': 'Too Many Requests: retry after 1', 'parameters': {'retry_after': 1}}
+                return 429, 'application/json', json.dumps(payload).encode()
+            payload = {'ok': True, 'result': handler(self._params(headers, body))}
+            return 200, 'application/json', json.dumps(payload).encode()
+        return endpoint
+    def _get_me(self, params: dict): return BOT_USER
+    def _true(self, params: dict): return True
+    def _no_updates(self, params: dict): return []
+    def _message(self, params: dict):
+        chat_id = int(params['chat_id'])
+        message_id = int(params.get('message_id') or next(self._message_ids))
+        return {'message_id': message_id, 'date': int(time.time()), 'text': params.get('text', ''), 'from': BOT_USER,
+                'chat': {'id': chat_id, 'type': 'private' if chat_id > 0 else 'supergroup'}}
+
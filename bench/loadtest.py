@@ -0,0 +1,231 @@
+"""Offline load test for bot.py.
+
+Runs the real Application and handlers against a fake Bot API server (fake_telegram.py) and an in-process
+fake Gemini model (fake_gemini.py), so no tokens or network are needed. Scenarios:
+
+  private    many users chatting with the bot in private (conversation memory, streaming if enabled)
+  ask        /ask bursts in authorized groups (response cache, group rate limits)
+  broadcast  one /broadcast to --users users through BroadcastJob
+
+Reports updates/sec, end-to-end p50/p99 (from update arrival to the reply, queueing included) and peak
+RSS, and optionally writes everything as JSON for comparing commits:
+
+  python bench/loadtest.py --scenario all --output before.json
+  python bench/loadtest.py --scenario all --output after.json --compare before.json
+
+Bot settings are read from the environment at import time, so any GEMINI_* / STREAM_* / BROADCAST_*
+variable can be set on the command line as usual.
+"""
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import logging
+import argparse
+import itertools
+import resource
+import tempfile
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BENCH_TOKEN = '123456:bench-token'
+SCENARIOS = ('private', 'ask', 'broadcast')
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--scenario', choices=SCENARIOS + ('all',), default='all')
+    parser.add_argument('--users', type=int, default=200, help="distinct private users / broadcast recipients")
+    parser.add_argument('--messages', type=int, default=1000, help="updates per private/ask scenario")
+    parser.add_argument('--groups', type=int, default=10, help="authorized groups for the ask scenario")
+    parser.add_argument('--rate', type=float, default=0, help="arrival rate in updates/sec (0 = all at once)")
+    parser.add_argument('--concurrency', type=int, default=256, help="updates in flight at once")
+    parser.add_argument('--repeat-ratio', type=float, default=0.3, help="share of /ask prompts repeated from earlier ones")
+    parser.add_argument('--gemini-latency-ms', type=float, default=800, help="median fake Gemini latency")
+    parser.add_argument('--gemini-error-rate', type=float, default=0.02)
+    parser.add_argument('--safety-rate', type=float, default=0.01)
+    parser.add_argument('--answer-chars', type=int, default=1200)
+    parser.add_argument('--telegram-latency-ms', type=float, default=5, help="fake Bot API latency per call")
+    parser.add_argument('--flood-rate', type=float, default=0.0, help="share of sends answered with 429 retry_after")
+    parser.add_argument('--broadcast-rate', type=float, default=1000, help="BROADCAST_RATE for the benchmark")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--verbose', action='store_true', help="keep the bot's and httpx's INFO logs")
+    parser.add_argument('--output', help="write results as JSON to this file")
+    parser.add_argument('--compare', help="previous JSON result to print deltas against")
+    return parser.parse_args()
+
+def configure_env(args, workdir: str):
+    """Must run before `import bot`: the bot reads its configuration at import time."""
+    defaults = {'GEMINI_API_KEY': 'bench', 'TELEGRAM_BOT_TOKEN': BENCH_TOKEN, 'ADMIN_ID': '1',
+                'DATA_FILE': os.path.join(workdir, 'data.json'), 'SQLITE_FILE': os.path.join(workdir, 'data.db'),
+                'BROADCAST_STATE_FILE': os.path.join(workdir, 'broadcast.json'), 'RESPONSE_CACHE_FILE': '',
+                'BROADCAST_RATE': str(args.broadcast_rate), 'BROADCAST_PROGRESS_INTERVAL': '3600',
+                'GEMINI_USER_RATE': '0', 'GEMINI_GROUP_RATE': '0', 'CHAT_HISTORY_PERSIST': 'false',
+                'UPDATE_CONCURRENCY': str(args.concurrency), 'METRICS_PORT': '0'}
+    for key, value in defaults.items(): os.environ.setdefault(key, value)
+    sys.path.insert(0, ROOT)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+def percentile(ordered: list[float], pct: float) -> float:
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))] if ordered else 0.0
+
+def peak_rss_mb() -> float:
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024  # bytes on macOS, KiB on Linux
+
+def git_commit() -> str | None:
+    try: return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=ROOT, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError): return None
+
+def message_update(update_id: int, chat: dict, user_id: int, text: str) -> dict:
+    message = {'message_id': update_id, 'date': int(time.time()), 'chat': chat, 'text': text,
+               'from': {'id': user_id, 'is_bot': False, 'first_name': f'User{user_id}'}}
+    if text.startswith('/'): message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+    return {'update_id': update_id, 'message': message}
+
+def private_updates(args, rng: random.Random) -> list[dict]:
+    updates = []
+    for i in range(args.messages):
+        user_id = 1000 + rng.randrange(args.users)
+        chat = {'id': user_id, 'type': 'private', 'first_name': f'User{user_id}'}
+        updates.append(message_update(i + 1, chat, user_id, f"question {i} about {rng.choice(['cats', 'rust', 'tea', 'rain'])}?"))
+    return updates
+
+def ask_updates(args, rng: random.Random, group_ids: list[int]) -> list[dict]:
+    updates, asked = [], []
+    for i in range(args.messages):
+        prompt = rng.choice(asked) if asked and rng.random() < args.repeat_ratio else f"what is topic number {i}?"
+        asked.append(prompt)
+        group_id = rng.choice(group_ids)
+        chat = {'id': group_id, 'type': 'supergroup', 'title': f'Group {-group_id}'}
+        updates.append(message_update(i + 1, chat, 1000 + rng.randrange(args.users), f"/ask {prompt}"))
+    return updates
+
+def reply_latencies(handled: list[tuple]) -> list[float]:
+    """Time from each update's arrival to the reply that answers it.
+
+    `handled` holds (chat_id, private, arrived, finished) in arrival order. A private message whose handler
+    returned after the chat's next message arrived was superseded, and the coalescer answers it together with
+    that next message; its reply therefore comes when the chat's next answering handler finishes.
+    """
+    latencies = []
+    for (chat_id, private), rows in itertools.groupby(sorted(handled, key=lambda row: (row[0], row[2])), key=lambda row: row[:2]):
+        rows, answered_at = list(rows), None
+        for i in reversed(range(len(rows))):
+            arrived, finished = rows[i][2:]
+            superseded = private and i + 1 < len(rows) and rows[i + 1][2] < finished
+            if not superseded or answered_at is None: answered_at = finished
+            latencies.append(answered_at - arrived)
+    return latencies
+
+async def replay(application, updates: list[dict], rate: float) -> dict:
+    """Feeds updates at `rate`/sec through process_update, bounded like the real update dispatcher."""
+    from telegram import Update
+    semaphore = asyncio.Semaphore(max(1, int(os.environ['UPDATE_CONCURRENCY'])))
+    handled, errors = [], 0
+    async def handle(data: dict):
+        nonlocal errors
+        arrived = time.perf_counter()
+        async with semaphore:
+            try: await application.process_update(Update.de_json(data, application.bot))
+            except Exception: errors += 1
+        chat = data.get('message', {}).get('chat', {})
+        handled.append((chat.get('id'), chat.get('type') == 'private', arrived, time.perf_counter()))
+    started = time.perf_counter()
+    tasks = []
+    for i, data in enumerate(updates):
+        if rate > 0: await asyncio.sleep(max(0.0, started + i / rate - time.perf_counter()))
+        tasks.append(asyncio.create_task(handle(data)))
+    await asyncio.gather(*tasks)
+    duration = time.perf_counter() - started
+    latencies = sorted(reply_latencies(handled))
+    return {'updates': len(updates), 'errors': errors, 'duration_s': round(duration, 3),
+            'updates_per_s': round(len(updates) / duration, 1) if duration else 0.0,
+            'p50_ms': round(percentile(latencies, 50) * 1000, 1), 'p99_ms': round(percentile(latencies, 99) * 1000, 1)}
+
+async def run_broadcast(bot, application, args) -> dict:
+    for i in range(args.users): bot.bot_data.add_user(10_000_000 + i)
+    job = bot.BroadcastJob.create("Benchmark broadcast", bot.ADMIN_ID, 1)
+    started = time.perf_counter()
+    await job.run(application.bot)
+    duration = time.perf_counter() - started
+    durations = bot.metrics.histograms.get('telegram_request_duration_seconds', {}).get((('method', 'broadcast'),))
+    recent = sorted(durations.recent) if durations else []
+    return {'updates': job.state['total'], 'sent': job.state['sent'], 'failed': job.state['failed'],
+            'duration_s': round(duration, 3), 'updates_per_s': round(job.state['sent'] / duration, 1) if duration else 0.0,
+            'p50_ms': round(percentile(recent, 50) * 1000, 1), 'p99_ms': round(percentile(recent, 99) * 1000, 1)}
+
+async def run(args) -> dict:
+    import bot
+    from fake_gemini import FakeGeminiModel
+    from fake_telegram import FakeTelegramServer
+
+    logging.getLogger().setLevel(logging.INFO if args.verbose else logging.WARNING)
+    for name in ('httpx', 'bot'): logging.getLogger(name).setLevel(logging.INFO if args.verbose else logging.WARNING)
+    rng = random.Random(args.seed)
+    gemini = FakeGeminiModel(args.gemini_latency_ms, error_rate=args.gemini_error_rate, safety_rate=args.safety_rate,
+                             answer_chars=args.answer_chars, seed=args.seed)
+    bot.gemini_client.model = gemini
+    telegram = FakeTelegramServer(BENCH_TOKEN, latency=args.telegram_latency_ms / 1000, flood_rate=args.flood_rate, seed=args.seed)
+    await telegram.start()
+    application = bot.build_application(BENCH_TOKEN, base_url=telegram.base_url)
+    await application.initialize()
+    await bot.post_init(application)
+    results = {}
+    try:
+        for scenario in (SCENARIOS if args.scenario == 'all' else (args.scenario,)):
+            calls_before, gemini_before, rejected_before = sum(telegram.calls.values()), gemini.calls, bot.gemini_scheduler.rejected
+            if scenario == 'private':
+                result = await replay(application, private_updates(args, rng), args.rate)
+            elif scenario == 'ask':
+                group_ids = [-1_000_000 - i for i in range(args.groups)]
+                for group_id in group_ids: bot.bot_data.add_group(group_id)
+                result = await replay(application, ask_updates(args, rng, group_ids), args.rate)
+            else:
+                result = await run_broadcast(bot, application, args)
+            result['telegram_calls'] = sum(telegram.calls.values()) - calls_before
+            result['gemini_calls'] = gemini.calls - gemini_before
+            result['busy_rejections'] = bot.gemini_scheduler.rejected - rejected_before
+            results[scenario] = result
+            print(f"{scenario:>10}: {result['updates']} in {result['duration_s']}s = {result['updates_per_s']}/s, "
+                  f"p50 {result['p50_ms']} ms, p99 {result['p99_ms']} ms, "
+                  f"{result['telegram_calls']} Bot API calls, {result['gemini_calls']} Gemini calls, {result['busy_rejections']} busy")
+    finally:
+        await bot.post_shutdown(application)
+        await application.shutdown()
+        await telegram.stop()
+    return {'scenarios': results, 'telegram_calls': dict(telegram.calls), 'telegram_floods': telegram.floods,
+            'gemini': {'calls': gemini.calls, 'errors': gemini.errors, 'blocked': gemini.blocked},
+            'handler_errors': sum(bot.metrics.counters.get('bot_handler_errors_total', {}).values()),
+            'cache': {'hits': bot.response_cache.hits, 'misses': bot.response_cache.misses, 'coalesced': bot.response_cache.coalesced},
+            'private': {'coalesced': bot.message_coalescer.coalesced, 'cancelled': bot.message_coalescer.cancelled}}
+
+def compare(results: dict, baseline_path: str):
+    with open(baseline_path, 'r', encoding='utf-8') as f: baseline = json.load(f)
+    print(f"\nvs {baseline_path} ({(baseline.get('commit') or '?')[:10]}):")
+    for scenario, result in results['scenarios'].items():
+        before = baseline.get('scenarios', {}).get(scenario)
+        if not before: continue
+        deltas = []
+        for key in ('updates_per_s', 'p50_ms', 'p99_ms'):
+            change = (result[key] - before[key]) / before[key] * 100 if before[key] else 0.0
+            deltas.append(f"{key} {before[key]} -> {result[key]} ({change:+.1f}%)")
+        print(f"{scenario:>10}: " + ', '.join(deltas))
+    change = results['peak_rss_mb'] - baseline.get('peak_rss_mb', 0)
+    print(f"{'peak rss':>10}: {baseline.get('peak_rss_mb')} -> {results['peak_rss_mb']} MB ({change:+.1f} MB)")
+
+def main():
+    args = parse_args()
+    with tempfile.TemporaryDirectory(prefix='gembot-bench-') as workdir:
+        configure_env(args, workdir)
+        results = asyncio.run(run(args))
+    results.update({'commit': git_commit(), 'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'), 'config': vars(args),
+                    'peak_rss_mb': round(peak_rss_mb(), 1)})
+    print(f"{'peak rss':>10}: {results['peak_rss_mb']} MB")
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f: json.dump(results, f, indent=2)
+    if args.compare: compare(results, args.compare)
+
+if __name__ == '__main__':
+    main()
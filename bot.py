@@ -1,9 +1,26 @@
 import os
 import json
+import hmac
+import signal
+import bisect
+import time
+import hashlib
+import sqlite3
+import threading
 import logging
+import random
 import asyncio
+import heapq
+import itertools
+import functools
+from abc import ABC, abstractmethod
+from contextlib import asynccontextmanager, contextmanager
+from collections import OrderedDict, deque
+from http import HTTPStatus
 import google.generativeai as genai
+from google.api_core import exceptions as google_exceptions
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, constants
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter, TelegramError
 from telegram.ext import (
     Application,
     CommandHandler,
@@ -21,13 +38,59 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 # --- ডেটা ফাইল এবং অনুবাদ ---
-DATA_FILE = 'data.json'
+DATA_FILE = os.getenv('DATA_FILE', 'data.json')
+DATA_FLUSH_INTERVAL = float(os.getenv('DATA_FLUSH_INTERVAL', 2))
+DATA_COMPACT_INTERVAL = float(os.getenv('DATA_COMPACT_INTERVAL', 600))
+STORAGE_BACKEND = os.getenv('STORAGE_BACKEND', 'json').lower()
+SQLITE_FILE = os.getenv('SQLITE_FILE', 'data.db')
+STREAM_RESPONSES = os.getenv('STREAM_RESPONSES', 'true').lower() in ('1', 'true', 'yes')
+STREAM_EDIT_INTERVAL = float(os.getenv('STREAM_EDIT_INTERVAL', 1.5))
+STREAM_GROUP_EDIT_INTERVAL = float(os.getenv('STREAM_GROUP_EDIT_INTERVAL', 3.5))
+MAX_MESSAGE_LENGTH = 4000
+GEMINI_MODEL = os.getenv('GEMINI_MODEL', 'gemini-2.5-flash')
+RESPONSE_CACHE_SIZE = int(os.getenv('RESPONSE_CACHE_SIZE', 1000))
+RESPONSE_CACHE_TTL = float(os.getenv('RESPONSE_CACHE_TTL', 900))
+RESPONSE_CACHE_FILE = os.getenv('RESPONSE_CACHE_FILE', '')
+GEMINI_TIMEOUT = float(os.getenv('GEMINI_TIMEOUT', 60))
+GEMINI_MAX_RETRIES = int(os.getenv('GEMINI_MAX_RETRIES', 2))
+GEMINI_RETRY_BASE_DELAY = float(os.getenv('GEMINI_RETRY_BASE_DELAY', 0.5))
+GEMINI_HEDGE_PERCENTILE = float(os.getenv('GEMINI_HEDGE_PERCENTILE', 0))  # e.g. 95; 0 disables hedging
+GEMINI_CONCURRENCY = int(os.getenv('GEMINI_CONCURRENCY', 8))
+GEMINI_QUEUE_SIZE = int(os.getenv('GEMINI_QUEUE_SIZE', 64))
+GEMINI_USER_RATE = float(os.getenv('GEMINI_USER_RATE', 6))  # requests per minute
+GEMINI_USER_BURST = float(os.getenv('GEMINI_USER_BURST', 3))
+GEMINI_GROUP_RATE = float(os.getenv('GEMINI_GROUP_RATE', 30))  # requests per minute
+GEMINI_GROUP_BURST = float(os.getenv('GEMINI_GROUP_BURST', 10))
+CHAT_HISTORY_TOKENS = int(os.getenv('CHAT_HISTORY_TOKENS', 2000))
+CHAT_SESSION_TTL = float(os.getenv('CHAT_SESSION_TTL', 1800))
+CHAT_MAX_SESSIONS = int(os.getenv('CHAT_MAX_SESSIONS', 5000))
+CHAT_HISTORY_PERSIST = os.getenv('CHAT_HISTORY_PERSIST', 'false').lower() in ('1', 'true', 'yes')
+PRIVATE_DEBOUNCE_MS = float(os.getenv('PRIVATE_DEBOUNCE_MS', 800))  # quick successive private messages become one prompt
+BROADCAST_STATE_FILE = os.getenv('BROADCAST_STATE_FILE', 'broadcast.json')
+BOT_MODE = os.getenv('BOT_MODE', 'polling').lower()
+WEBHOOK_URL = os.getenv('WEBHOOK_URL', '')
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/webhook')
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET', '')
+WEBHOOK_LISTEN = os.getenv('WEBHOOK_LISTEN', '0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('PORT', 8080))
+UPDATE_CONCURRENCY = int(os.getenv('UPDATE_CONCURRENCY', 64))
+SHUTDOWN_GRACE_PERIOD = float(os.getenv('SHUTDOWN_GRACE_PERIOD', 25))
+HTTP_MAX_BODY = 1024 * 1024
+HTTP_MAX_LINE = 16 * 1024  # request line or one header
+HTTP_MAX_HEADERS = 100
+HTTP_READ_TIMEOUT = float(os.getenv('HTTP_READ_TIMEOUT', 30))
+METRICS_PORT = int(os.getenv('METRICS_PORT', 0))
+METRICS_LISTEN = os.getenv('METRICS_LISTEN', '127.0.0.1')
+BROADCAST_RATE = float(os.getenv('BROADCAST_RATE', 25))
+BROADCAST_CONCURRENCY = int(os.getenv('BROADCAST_CONCURRENCY', 10))
+BROADCAST_BATCH_SIZE = int(os.getenv('BROADCAST_BATCH_SIZE', 500))
+BROADCAST_PROGRESS_INTERVAL = float(os.getenv('BROADCAST_PROGRESS_INTERVAL', 10))
 TRANSLATIONS = {
     'en': {
         'welcome': "👋 Welcome to GemBot AI!\n\nI'm powered by Google Gemini and can help you with any questions. Choose an option below:",
         'start_chat': '💬 Start Chat with AI', 'membership_info': '💎 Membership Info', 'contact_admin': '📞 Contact Admin',
         'membership_text': "💎 **Membership Information**\n\nTo use this bot in your group, contact the admin (@otakuosenpai) for authorization.",
-        'help_text': "📖 **How to Use This Bot**\n\n**Private Chat:**\nJust send me any message!\n\n**In Groups:**\nUse the command `/ask <your question>` to get a response from me.",
+        'help_text': "📖 **How to Use This Bot**\n\n**Private Chat:**\nJust send me any message! I remember the recent conversation; use /reset to start over.\n\n**In Groups:**\nUse the command `/ask <your question>` to get a response from me.",
         'myinfo_text': "👤 **Your Information**\n\nUser ID: `{user_id}`\nSelected Language: `{language}`",
         'about_text': "🤖 **About This Bot**\n\nAI assistant powered by Google Gemini.\nMade with ❤️ by MD Salman",
         'choose_language': "🌐 Choose your preferred language:", 'language_updated': "✅ Language updated to {lang}!",
@@ -36,12 +99,17 @@ TRANSLATIONS = {
         'group_removed': "✅ Group `{group_id}` has been unauthorized!", 'group_list': "📋 **Authorized Groups** ({count}):\n\n`{groups}`",
         'no_groups': "No authorized groups yet.", 'user_banned': "✅ User `{user_id}` has been banned!",
         'user_unbanned': "✅ User `{user_id}` has been unbanned!", 'banned_list': "🚫 **Banned Users** ({count}):\n\n`{users}`",
-        'no_banned': "No banned users.", 'stats_text': "📊 **Bot Statistics**\n\nTotal Users: {users}\nAuthorized Groups: {groups}\nBanned Users: {banned}",
-        'broadcast_confirm': "📢 Send this message to {count} users?\n\n`{message}`", 'broadcast_sent': "✅ Broadcast sent to {count} users!",
+        'no_banned': "No banned users.", 'stats_text': "📊 **Bot Statistics**\n\nTotal Users: {users}\nAuthorized Groups: {groups}\nBanned Users: {banned}\n\nResponse Cache: {cache_size} entries, {cache_hits} hits, {cache_misses} misses, {cache_coalesced} coalesced\nGemini: {gemini_active}/{gemini_concurrency} active, {gemini_queued} queued, avg wait {gemini_wait_ms:.0f} ms, {gemini_rejected} rejected",
+        'broadcast_confirm': "📢 Send this message to {count} users?\n\n`{message}`", 'broadcast_sent': "✅ **Broadcast finished**\n\nSent: {sent}\nFailed: {failed}\nPruned (blocked/deleted): {pruned}\nTime: {elapsed:.0f}s ({rate:.1f} msg/s)",
+        'broadcast_started': "📢 Broadcast to {count} users started in the background.", 'broadcast_running': "⚠️ Another broadcast is still running.",
+        'broadcast_progress': "📢 Broadcasting… {done}/{total}\n\nSent: {sent}\nFailed: {failed}\nPruned: {pruned}\nRate: {rate:.1f} msg/s",
         'broadcast_cancelled': "❌ Broadcast cancelled.", 'group_unauthorized': "⚠️ This group is not authorized. Contact @otakuosenpai for access. The bot will now leave.",
-        'admin_help': "🔧 **Admin Panel**\n\n/addgroup `<id>`\n/removegroup `<id>`\n/listgroups\n/ban `<user_id>`\n/unban `<user_id>`\n/listbanned\n/broadcast `<msg>`\n/stats",
+        'admin_help': "🔧 **Admin Panel**\n\n/addgroup `<id>`\n/removegroup `<id>`\n/listgroups\n/ban `<user_id>`\n/unban `<user_id>`\n/listbanned\n/broadcast `<msg>`\n/stats\n/perf",
         'api_error': "Sorry, I'm facing an issue with the AI service. Please try again later.", 'safety_block': "I couldn't process that request due to safety guidelines.",
-        'usage_error': "⚠️ Usage: `{command}`"
+        'usage_error': "⚠️ Usage: `{command}`", 'busy': "⏳ I'm handling a lot of requests right now. Please try again in a minute.",
+        'rate_limited': "⏳ You're sending requests too quickly. Please wait a moment and try again.",
+        'session_reset': "🧹 Conversation cleared. Let's start fresh!", 'perf_text': "⏱ **Latency (recent window)**\n\n```\n{lines}\n```",
+        'perf_empty': "No latency samples recorded yet."
     },
     'bn': {
         'welcome': "👋 GemBot AI-তে স্বাগতম!\n\nআমি গুগল জেমিনি দ্বারা চালিত এবং যেকোনো প্রশ্নে আপনাকে সাহায্য করতে পারি। নিচের একটি অপশন বেছে নিন:",
@@ -51,43 +119,470 @@ TRANSLATIONS = {
     }
 }
 
+# --- মেট্রিক্স ---
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+class Histogram:
+    __slots__ = ('counts', 'sum', 'count', 'recent')
+    def __init__(self):
+        self.counts = [0] * len(LATENCY_BUCKETS)
+        self.sum, self.count = 0.0, 0
+        self.recent = deque(maxlen=1024)  # window for the p50/p95/p99 shown by /perf
+    def observe(self, value: float):
+        index = bisect.bisect_left(LATENCY_BUCKETS, value)
+        if index < len(self.counts): self.counts[index] += 1
+        self.sum += value; self.count += 1
+        self.recent.append(value)
+    def percentiles(self, *quantiles: float) -> list[float]:
+        ordered = sorted(self.recent)
+        return [ordered[int(q * (len(ordered) - 1))] if ordered else 0.0 for q in quantiles]
+
+class Metrics:
+    """In-process counters and latency histograms, rendered in the Prometheus text format.
+
+    Metrics are created on first use; `describe()` only adds the HELP line. `collect()` registers a callable
+    read at scrape time, for values other components already track (queue depth, cache hits, ...).
+    """
+    def __init__(self):
+        self.counters: dict[str, dict[tuple, float]] = {}
+        self.histograms: dict[str, dict[tuple, Histogram]] = {}
+        self.collectors: dict[str, tuple[str, object]] = {}
+        self.help: dict[str, str] = {}
+    def describe(self, name: str, help_text: str): self.help[name] = help_text
+    def inc(self, name: str, amount: float = 1, **labels):
+        series = self.counters.setdefault(name, {})
+        key = tuple(sorted(labels.items()))
+        series[key] = series.get(key, 0) + amount
+    def observe(self, name: str, value: float, **labels):
+        series = self.histograms.setdefault(name, {})
+        key = tuple(sorted(labels.items()))
+        if key not in series: series[key] = Histogram()
+        series[key].observe(value)
+    @contextmanager
+    def timer(self, name: str, **labels):
+        started = time.perf_counter()
+        try: yield
+        finally: self.observe(name, time.perf_counter() - started, **labels)
+    def collect(self, name: str, kind: str, help_text: str, func):
+        self.collectors[name] = (kind, func); self.help[name] = help_text
+    @staticmethod
+    def _labels(key: tuple, **extra) -> str:
+        pairs = list(key) + list(extra.items())
+        if not pairs: return ''
+        escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+        return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+    def _header(self, lines: list[str], name: str, kind: str):
+        if name in self.help: lines.append(f"# HELP {name} {self.help[name]}")
+        lines.append(f"# TYPE {name} {kind}")
+    def render(self) -> str:
+        lines = []
+        for name, series in sorted(self.counters.items()):
+            self._header(lines, name, 'counter')
+            lines.extend(f"{name}{self._labels(key)} {value}" for key, value in series.items())
+        for name, series in sorted(self.histograms.items()):
+            self._header(lines, name, 'histogram')
+            for key, histogram in series.items():
+                cumulative = 0
+                for bound, count in zip(LATENCY_BUCKETS, histogram.counts):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{self._labels(key, le=bound)} {cumulative}")
+                lines.append(f"{name}_bucket{self._labels(key, le='+Inf')} {histogram.count}")
+                lines.append(f"{name}_sum{self._labels(key)} {histogram.sum}")
+                lines.append(f"{name}_count{self._labels(key)} {histogram.count}")
+        for name, (kind, func) in sorted(self.collectors.items()):
+            try: value = func()
+            except Exception as e: logger.warning(f"Metric collector {name} failed: {e}"); continue
+            self._header(lines, name, kind)
+            lines.append(f"{name} {value}")
+        return '\n'.join(lines) + '\n'
+    def summary(self) -> list[str]:
+        """One line per histogram series with p50/p95/p99 over the recent window, for /perf."""
+        lines = []
+        for name, series in sorted(self.histograms.items()):
+            for key, histogram in sorted(series.items()):
+                p50, p95, p99 = (value * 1000 for value in histogram.percentiles(0.5, 0.95, 0.99))
+                label = ','.join(str(value) for _, value in key)
+                lines.append(f"{name.removesuffix('_seconds')}{f'[{label}]' if label else ''}: "
+                             f"p50 {p50:.0f} · p95 {p95:.0f} · p99 {p99:.0f} ms (n={histogram.count})")
+        return lines
+
+metrics = Metrics()
+metrics.describe('bot_handler_duration_seconds', 'Time spent in each update handler.')
+metrics.describe('bot_handler_errors_total', 'Update handlers that raised an exception.')
+metrics.describe('gemini_request_duration_seconds', 'Gemini request latency, excluding time queued for a slot (and, for streams, Telegram edits).')
+metrics.describe('gemini_ttft_seconds', 'Time to first streamed Gemini chunk.')
+metrics.describe('gemini_queue_wait_seconds', 'Time spent waiting for a Gemini slot.')
+metrics.describe('gemini_requests_total', 'Gemini requests by outcome (ok, safety_block, error, busy).')
+metrics.describe('gemini_tokens_total', 'Gemini tokens reported in usage metadata.')
+metrics.describe('gemini_retries_total', 'Gemini attempts retried after a retryable error.')
+metrics.describe('gemini_hedges_total', 'Hedged second Gemini requests sent.')
+metrics.describe('telegram_request_duration_seconds', 'Telegram Bot API call latency for outgoing messages.')
+metrics.describe('telegram_retries_total', 'Telegram calls delayed or retried after flood control or network errors.')
+metrics.describe('telegram_pacing_delay_seconds', 'Time a message waited for its chat\'s learned send gap.')
+metrics.describe('telegram_markdown_fallbacks_total', 'Messages resent as plain text after Telegram rejected their Markdown.')
+metrics.describe('storage_flush_duration_seconds', 'Time to flush or compact BotData storage.')
+
+def instrumented(name: str, callback):
+    """Wraps a handler callback so its latency and failures are recorded under `name`."""
+    @functools.wraps(callback)
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        started = time.perf_counter()
+        try: return await callback(update, context)
+        except Exception:
+            metrics.inc('bot_handler_errors_total', handler=name)
+            raise
+        finally: metrics.observe('bot_handler_duration_seconds', time.perf_counter() - started, handler=name)
+    return wrapper
+
+def record_gemini_usage(response):
+    usage = getattr(response, 'usage_metadata', None)
+    if not usage: return
+    metrics.inc('gemini_tokens_total', getattr(usage, 'prompt_token_count', 0) or 0, kind='prompt')
+    metrics.inc('gemini_tokens_total', getattr(usage, 'candidates_token_count', 0) or 0, kind='completion')
+
 # --- ডেটা ম্যানেজমেন্ট ক্লাস ---
-class BotData:
+class Storage(ABC):
+    """Interface implemented by every BotData backend.
+
+    Mutations may be buffered; `flush()` makes them durable, `compact()` does heavier housekeeping
+    and `close()` is called once at shutdown.
+    """
+    @abstractmethod
+    def add_user(self, user_id: int): ...
+    @abstractmethod
+    def remove_user(self, user_id: int): ...
+    @abstractmethod
+    def user_batch(self, after: int | None, limit: int) -> list[int]: ...
+    @abstractmethod
+    def count_users(self) -> int: ...
+    @abstractmethod
+    def get_user_language(self, user_id: int) -> str: ...
+    @abstractmethod
+    def set_user_language(self, user_id: int, lang: str): ...
+    @abstractmethod
+    def is_user_banned(self, user_id: int) -> bool: ...
+    @abstractmethod
+    def ban_user(self, user_id: int): ...
+    @abstractmethod
+    def unban_user(self, user_id: int): ...
+    @abstractmethod
+    def list_banned(self) -> list[int]: ...
+    def count_banned(self) -> int: return len(self.list_banned())
+    @abstractmethod
+    def is_group_authorized(self, group_id: int) -> bool: ...
+    @abstractmethod
+    def add_group(self, group_id: int): ...
+    @abstractmethod
+    def remove_group(self, group_id: int): ...
+    @abstractmethod
+    def list_groups(self) -> list[int]: ...
+    def count_groups(self) -> int: return len(self.list_groups())
+    @abstractmethod
+    def get_history(self, user_id: int) -> dict | None: ...
+    @abstractmethod
+    def set_history(self, user_id: int, history: dict): ...
+    @abstractmethod
+    def delete_history(self, user_id: int): ...
+    @abstractmethod
+    async def expire_histories(self, before: float) -> int: ...
+    async def flush(self): pass
+    async def compact(self): await self.flush()
+    async def close(self): await self.compact()
+
+class JsonStorage(Storage):
+    """Set/dict indexes in memory, persisted as a data.json snapshot plus an append-only change log.
+
+    Every mutation updates the indexes right away and queues one log record. `flush()` appends the
+    queued records to `<data file>.log` in a worker thread, and `compact()` folds the current state
+    into a new snapshot (temp file + rename) and truncates the log.
+    """
     def __init__(self, file_path):
         self.file_path = file_path
-        self.data = self._load()
+        self.log_path = file_path + '.log'
+        self._pending: list[str] = []
+        self._lock: asyncio.Lock | None = None
+        self._load()
     def _load(self):
         try:
-            with open(self.file_path, 'r', encoding='utf-8') as f: return json.load(f)
-        except (FileNotFoundError, json.JSONDecodeError):
-            return {'authorized_group_ids': [], 'banned_user_ids': [], 'user_languages': {}, 'all_users': []}
-    def _save(self):
+            with open(self.file_path, 'r', encoding='utf-8') as f: data = json.load(f)
+        except FileNotFoundError:
+            data = {}
+        except json.JSONDecodeError as e:
+            # Keep the damaged file for manual recovery instead of overwriting it on the next compaction
+            logger.error(f"{self.file_path} is corrupt ({e}); moving it to {self.file_path}.corrupt")
+            os.replace(self.file_path, self.file_path + '.corrupt')
+            data = {}
+        # dict.fromkeys keeps insertion order, so these behave as ordered sets
+        self.all_users = dict.fromkeys(data.get('all_users', []))
+        self.sorted_users = sorted(self.all_users)  # kept in step with all_users so broadcasts can page by id
+        self.banned_user_ids = set(data.get('banned_user_ids', []))
+        self.authorized_group_ids = dict.fromkeys(data.get('authorized_group_ids', []))
+        self.user_languages = dict(data.get('user_languages', {}))
+        self.chat_histories = dict(data.get('chat_histories', {}))
         try:
-            with open(self.file_path, 'w', encoding='utf-8') as f: json.dump(self.data, f, indent=2, ensure_ascii=False)
-        except Exception as e: logger.error(f"Failed to save data: {e}")
+            with open(self.log_path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try: self._apply(*json.loads(line))
+                    except (ValueError, TypeError): logger.warning(f"Skipping unreadable change log record: {line!r}")
+        except FileNotFoundError: pass
+    def _apply(self, op: str, *args):
+        if op == 'add_user':
+            if args[0] not in self.all_users: bisect.insort(self.sorted_users, args[0])
+            self.all_users[args[0]] = None
+        elif op == 'remove_user':
+            if args[0] in self.all_users:
+                del self.all_users[args[0]]
+                del self.sorted_users[bisect.bisect_left(self.sorted_users, args[0])]
+        elif op == 'set_lang': self.user_languages[str(args[0])] = args[1]
+        elif op == 'ban': self.banned_user_ids.add(args[0])
+        elif op == 'unban': self.banned_user_ids.discard(args[0])
+        elif op == 'add_group': self.authorized_group_ids[args[0]] = None
+        elif op == 'remove_group': self.authorized_group_ids.pop(args[0], None)
+        elif op == 'set_history': self.chat_histories[str(args[0])] = args[1]
+        elif op == 'del_history': self.chat_histories.pop(str(args[0]), None)
+        else: raise ValueError(f"Unknown change log op: {op}")
+    def _change(self, op: str, *args):
+        self._apply(op, *args)
+        self._pending.append(json.dumps([op, *args], ensure_ascii=False) + '\n')
+    def _get_lock(self) -> asyncio.Lock:
+        if self._lock is None: self._lock = asyncio.Lock()
+        return self._lock
+    def snapshot(self) -> dict:
+        return {'authorized_group_ids': list(self.authorized_group_ids), 'banned_user_ids': list(self.banned_user_ids),
+                'user_languages': dict(self.user_languages), 'all_users': list(self.all_users),
+                'chat_histories': dict(self.chat_histories)}
+    def _append_log(self, lines: list[str]):
+        with open(self.log_path, 'a', encoding='utf-8') as f:
+            f.writelines(lines); f.flush(); os.fsync(f.fileno())
+    def _write_snapshot(self, data: dict):
+        tmp_path = self.file_path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False, separators=(',', ':')); f.flush(); os.fsync(f.fileno())
+        os.replace(tmp_path, self.file_path)
+        # Records already folded into the snapshot are safe to drop; replaying them again would be harmless too
+        open(self.log_path, 'w').close()
+    async def flush(self):
+        async with self._get_lock():
+            if not self._pending: return
+            lines, self._pending = self._pending, []
+            try: await asyncio.to_thread(self._append_log, lines)
+            except Exception as e:
+                logger.error(f"Failed to append change log: {e}")
+                self._pending[:0] = lines
+    async def compact(self):
+        async with self._get_lock():
+            # The snapshot is copied on the event loop so handlers can't mutate it mid-write
+            data, lines, self._pending = self.snapshot(), self._pending, []
+            try: await asyncio.to_thread(self._write_snapshot, data)
+            except Exception as e:
+                logger.error(f"Failed to save data: {e}")
+                self._pending[:0] = lines
     def add_user(self, user_id: int):
-        if user_id not in self.data['all_users']: self.data['all_users'].append(user_id); self._save()
-    def get_user_language(self, user_id: int) -> str: return self.data['user_languages'].get(str(user_id), 'en')
-    def set_user_language(self, user_id: int, lang: str): self.data['user_languages'][str(user_id)] = lang; self._save()
-    def is_user_banned(self, user_id: int) -> bool: return user_id in self.data['banned_user_ids']
+        if user_id not in self.all_users: self._change('add_user', user_id)
+    def remove_user(self, user_id: int):
+        if user_id in self.all_users: self._change('remove_user', user_id)
+    def user_batch(self, after: int | None, limit: int) -> list[int]:
+        start = 0 if after is None else bisect.bisect_right(self.sorted_users, after)
+        return self.sorted_users[start:start + limit]
+    def count_users(self) -> int: return len(self.all_users)
+    def get_user_language(self, user_id: int) -> str: return self.user_languages.get(str(user_id), 'en')
+    def set_user_language(self, user_id: int, lang: str):
+        if self.user_languages.get(str(user_id)) != lang: self._change('set_lang', user_id, lang)
+    def is_user_banned(self, user_id: int) -> bool: return user_id in self.banned_user_ids
     def ban_user(self, user_id: int):
-        if user_id not in self.data['banned_user_ids']: self.data['banned_user_ids'].append(user_id); self._save()
+        if user_id not in self.banned_user_ids: self._change('ban', user_id)
     def unban_user(self, user_id: int):
-        if user_id in self.data['banned_user_ids']: self.data['banned_user_ids'].remove(user_id); self._save()
-    def is_group_authorized(self, group_id: int) -> bool: return group_id in self.data['authorized_group_ids']
+        if user_id in self.banned_user_ids: self._change('unban', user_id)
+    def list_banned(self) -> list[int]: return list(self.banned_user_ids)
+    def count_banned(self) -> int: return len(self.banned_user_ids)
+    def is_group_authorized(self, group_id: int) -> bool: return group_id in self.authorized_group_ids
     def add_group(self, group_id: int):
-        if group_id not in self.data['authorized_group_ids']: self.data['authorized_group_ids'].append(group_id); self._save()
+        if group_id not in self.authorized_group_ids: self._change('add_group', group_id)
     def remove_group(self, group_id: int):
-        if group_id in self.data['authorized_group_ids']: self.data['authorized_group_ids'].remove(group_id); self._save()
+        if group_id in self.authorized_group_ids: self._change('remove_group', group_id)
+    def list_groups(self) -> list[int]: return list(self.authorized_group_ids)
+    def count_groups(self) -> int: return len(self.authorized_group_ids)
+    def get_history(self, user_id: int) -> dict | None: return self.chat_histories.get(str(user_id))
+    def set_history(self, user_id: int, history: dict): self._change('set_history', user_id, history)
+    def delete_history(self, user_id: int):
+        if str(user_id) in self.chat_histories: self._change('del_history', user_id)
+    async def expire_histories(self, before: float) -> int:
+        expired = [user_id for user_id, history in self.chat_histories.items() if history['last_used'] < before]
+        for user_id in expired: self._change('del_history', int(user_id))
+        return len(expired)
+
+class SqliteStorage(Storage):
+    """SQLite backend in WAL mode. Writes join an open transaction that `flush()` commits in a worker thread."""
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS users (user_id INTEGER PRIMARY KEY);
+        CREATE TABLE IF NOT EXISTS user_languages (user_id INTEGER PRIMARY KEY, lang TEXT NOT NULL);
+        CREATE TABLE IF NOT EXISTS banned_users (user_id INTEGER PRIMARY KEY);
+        CREATE TABLE IF NOT EXISTS authorized_groups (group_id INTEGER PRIMARY KEY);
+        CREATE TABLE IF NOT EXISTS chat_histories (user_id INTEGER PRIMARY KEY, history TEXT NOT NULL);
+        CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+    """
+    def __init__(self, db_path):
+        self.db_path = db_path
+        # Handlers read on the event loop and commits run in a worker thread, so every use goes through _db_lock.
+        # With WAL and synchronous=NORMAL a commit never fsyncs; only checkpoints do. Automatic checkpoints are
+        # turned off on this connection so that no commit runs one while holding _db_lock; compact() checkpoints
+        # instead, on a separate connection that never takes the lock, so lookups don't wait for checkpoint I/O.
+        self._db_lock = threading.Lock()
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute('PRAGMA wal_autocheckpoint=0')
+        self.conn.executescript(self.SCHEMA)
+        self._maintenance_conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._maintenance_conn.execute('PRAGMA synchronous=NORMAL')
+        self._dirty = False
+        self._user_count = self._scalar('SELECT COUNT(*) FROM users')
+    def _scalar(self, sql: str, params=()):
+        with self._db_lock:
+            row = self.conn.execute(sql, params).fetchone()
+        return row[0] if row else None
+    def _write(self, sql: str, params=()) -> int:
+        with self._db_lock:
+            rowcount = self.conn.execute(sql, params).rowcount
+            self._dirty = True
+        return rowcount
+    def _column(self, sql: str) -> list:
+        with self._db_lock:
+            return [row[0] for row in self.conn.execute(sql)]
+    def import_json(self, file_path: str) -> bool:
+        """One-shot migration from a data.json snapshot (and its change log); the files are renamed afterwards."""
+        if self._scalar("SELECT value FROM meta WHERE key = 'imported_from'") is not None: return False
+        if not os.path.exists(file_path) and not os.path.exists(file_path + '.log'): return False
+        data = JsonStorage(file_path).snapshot()
+        with self._db_lock, self.conn:
+            self.conn.executemany('INSERT OR IGNORE INTO users VALUES (?)', ((uid,) for uid in data['all_users']))
+            self.conn.executemany('INSERT OR REPLACE INTO user_languages VALUES (?, ?)', ((int(uid), lang) for uid, lang in data['user_languages'].items()))
+            self.conn.executemany('INSERT OR IGNORE INTO banned_users VALUES (?)', ((uid,) for uid in data['banned_user_ids']))
+            self.conn.executemany('INSERT OR IGNORE INTO authorized_groups VALUES (?)', ((gid,) for gid in data['authorized_group_ids']))
+            self.conn.executemany('INSERT OR REPLACE INTO chat_histories VALUES (?, ?)',
+                                  ((int(uid), json.dumps(history, ensure_ascii=False)) for uid, history in data['chat_histories'].items()))
+            self.conn.execute("INSERT INTO meta VALUES ('imported_from', ?)", (file_path,))
+        for path in (file_path, file_path + '.log'):
+            if os.path.exists(path): os.replace(path, path + '.migrated')
+        self._user_count = self._scalar('SELECT COUNT(*) FROM users')
+        logger.info(f"Imported {self._user_count} users from {file_path} into {self.db_path}")
+        return True
+    def _commit(self):
+        with self._db_lock:
+            if self._dirty: self.conn.commit(); self._dirty = False
+    async def flush(self): await asyncio.to_thread(self._commit)
+    def _checkpoint(self, mode: str):
+        self._maintenance_conn.execute(f'PRAGMA wal_checkpoint({mode})').fetchone()
+    def _close(self):
+        with self._db_lock: self.conn.close()
+        self._checkpoint('TRUNCATE')
+        self._maintenance_conn.close()
+    async def compact(self):
+        await self.flush()
+        await asyncio.to_thread(self._checkpoint, 'PASSIVE')
+    async def close(self):
+        await self.flush()
+        await asyncio.to_thread(self._close)
+    def add_user(self, user_id: int):
+        if self._write('INSERT OR IGNORE INTO users VALUES (?)', (user_id,)): self._user_count += 1
+    def remove_user(self, user_id: int):
+        if self._write('DELETE FROM users WHERE user_id = ?', (user_id,)): self._user_count -= 1
+    def user_batch(self, after: int | None, limit: int) -> list[int]:
+        with self._db_lock:
+            if after is None: rows = self.conn.execute('SELECT user_id FROM users ORDER BY user_id LIMIT ?', (limit,))
+            else: rows = self.conn.execute('SELECT user_id FROM users WHERE user_id > ? ORDER BY user_id LIMIT ?', (after, limit))
+            return [row[0] for row in rows]
+    def count_users(self) -> int: return self._user_count
+    def get_user_language(self, user_id: int) -> str:
+        return self._scalar('SELECT lang FROM user_languages WHERE user_id = ?', (user_id,)) or 'en'
+    def set_user_language(self, user_id: int, lang: str):
+        self._write('INSERT OR REPLACE INTO user_languages VALUES (?, ?)', (user_id, lang))
+    def is_user_banned(self, user_id: int) -> bool:
+        return self._scalar('SELECT 1 FROM banned_users WHERE user_id = ?', (user_id,)) is not None
+    def ban_user(self, user_id: int): self._write('INSERT OR IGNORE INTO banned_users VALUES (?)', (user_id,))
+    def unban_user(self, user_id: int): self._write('DELETE FROM banned_users WHERE user_id = ?', (user_id,))
+    def list_banned(self) -> list[int]: return self._column('SELECT user_id FROM banned_users')
+    def count_banned(self) -> int: return self._scalar('SELECT COUNT(*) FROM banned_users')
+    def is_group_authorized(self, group_id: int) -> bool:
+        return self._scalar('SELECT 1 FROM authorized_groups WHERE group_id = ?', (group_id,)) is not None
+    def add_group(self, group_id: int): self._write('INSERT OR IGNORE INTO authorized_groups VALUES (?)', (group_id,))
+    def remove_group(self, group_id: int): self._write('DELETE FROM authorized_groups WHERE group_id = ?', (group_id,))
+    def list_groups(self) -> list[int]: return self._column('SELECT group_id FROM authorized_groups')
+    def count_groups(self) -> int: return self._scalar('SELECT COUNT(*) FROM authorized_groups')
+    def get_history(self, user_id: int) -> dict | None:
+        history = self._scalar('SELECT history FROM chat_histories WHERE user_id = ?', (user_id,))
+        return json.loads(history) if history else None
+    def set_history(self, user_id: int, history: dict):
+        self._write('INSERT OR REPLACE INTO chat_histories VALUES (?, ?)', (user_id, json.dumps(history, ensure_ascii=False)))
+    def delete_history(self, user_id: int): self._write('DELETE FROM chat_histories WHERE user_id = ?', (user_id,))
+    async def expire_histories(self, before: float) -> int:
+        return await asyncio.to_thread(self._write, "DELETE FROM chat_histories WHERE json_extract(history, '$.last_used') < ?", (before,))
+
+STORAGE_BACKENDS = {'json': JsonStorage, 'sqlite': SqliteStorage}
+
+class BotData:
+    """Facade the handlers talk to; the actual persistence is delegated to a Storage backend."""
+    def __init__(self, storage: Storage):
+        self.storage = storage
+    @classmethod
+    def from_env(cls) -> 'BotData':
+        backend = STORAGE_BACKEND if STORAGE_BACKEND in STORAGE_BACKENDS else 'json'
+        if backend != STORAGE_BACKEND: logger.warning(f"Unknown STORAGE_BACKEND '{STORAGE_BACKEND}', falling back to json")
+        if backend == 'sqlite':
+            storage = SqliteStorage(SQLITE_FILE)
+            storage.import_json(DATA_FILE)
+            return cls(storage)
+        return cls(JsonStorage(DATA_FILE))
+    def add_user(self, user_id: int): self.storage.add_user(user_id)
+    def remove_user(self, user_id: int): self.storage.remove_user(user_id)
+    def user_batch(self, after: int | None, limit: int) -> list[int]: return self.storage.user_batch(after, limit)
+    def count_users(self) -> int: return self.storage.count_users()
+    def get_user_language(self, user_id: int) -> str: return self.storage.get_user_language(user_id)
+    def set_user_language(self, user_id: int, lang: str): self.storage.set_user_language(user_id, lang)
+    def is_user_banned(self, user_id: int) -> bool: return self.storage.is_user_banned(user_id)
+    def ban_user(self, user_id: int): self.storage.ban_user(user_id)
+    def unban_user(self, user_id: int): self.storage.unban_user(user_id)
+    def list_banned(self) -> list[int]: return self.storage.list_banned()
+    def count_banned(self) -> int: return self.storage.count_banned()
+    def is_group_authorized(self, group_id: int) -> bool: return self.storage.is_group_authorized(group_id)
+    def add_group(self, group_id: int): self.storage.add_group(group_id)
+    def remove_group(self, group_id: int): self.storage.remove_group(group_id)
+    def list_groups(self) -> list[int]: return self.storage.list_groups()
+    def count_groups(self) -> int: return self.storage.count_groups()
+    def get_history(self, user_id: int) -> dict | None: return self.storage.get_history(user_id)
+    def set_history(self, user_id: int, history: dict): self.storage.set_history(user_id, history)
+    def delete_history(self, user_id: int): self.storage.delete_history(user_id)
+    async def expire_histories(self, before: float) -> int: return await self.storage.expire_histories(before)
+    async def flush(self): await self.storage.flush()
+    async def compact(self): await self.storage.compact()
+    async def close(self): await self.storage.close()
+
+async def storage_maintenance():
+    """Background write-behind loop: flush the change log often, compact it occasionally.
+
+    Persisted chat histories idle for longer than CHAT_SESSION_TTL are dropped before every compaction
+    (and once at startup), since ConversationMemory would never load them again.
+    """
+    last_compaction = None
+    while True:
+        if last_compaction is not None: await asyncio.sleep(DATA_FLUSH_INTERVAL)
+        try:
+            with metrics.timer('storage_flush_duration_seconds', op='flush'): await bot_data.flush()
+            if last_compaction is None or time.monotonic() - last_compaction >= DATA_COMPACT_INTERVAL:
+                expired = await bot_data.expire_histories(time.time() - CHAT_SESSION_TTL)
+                if expired: logger.info(f"Dropped {expired} expired chat histories")
+                with metrics.timer('storage_flush_duration_seconds', op='compact'): await bot_data.compact()
+                last_compaction = time.monotonic()
+        except Exception as e: logger.error(f"Storage maintenance failed: {e}")
 
 # --- গ্লোবাল ভ্যারিয়েবল এবং ক্লায়েন্ট সেটআপ ---
-bot_data = BotData(DATA_FILE)
+bot_data = BotData.from_env()
 ADMIN_ID = int(os.getenv('ADMIN_ID', 0))
 try:
     GEMINI_API_KEY = os.getenv('GEMINI_API_KEY')
     if not GEMINI_API_KEY: raise ValueError("GEMINI_API_KEY not found")
     genai.configure(api_key=GEMINI_API_KEY)
-    gemini_model = genai.GenerativeModel('gemini-2.5-flash')
+    gemini_model = genai.GenerativeModel(GEMINI_MODEL)
 except Exception as e:
     logger.critical(f"FATAL: Failed to configure Gemini API - {e}")
     gemini_model = None
@@ -99,39 +594,873 @@ def get_text(user_id: int, key: str, **kwargs) -> str:
     return text.format(**kwargs) if kwargs else text
 def is_admin(user_id: int) -> bool: return user_id == ADMIN_ID
 
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate, self.capacity = rate, capacity
+        self.tokens, self.updated = capacity, time.monotonic()
+    def try_acquire(self, tokens: float = 1.0) -> bool:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens < tokens: return False
+        self.tokens -= tokens
+        return True
+    async def acquire(self, tokens: float = 1.0):
+        while not self.try_acquire(tokens): await asyncio.sleep((tokens - self.tokens) / self.rate)
+
+class KeyedRateLimiter:
+    """One token bucket per key (user or chat id); the least recently used buckets are dropped past max_keys."""
+    def __init__(self, per_minute: float, burst: float, max_keys: int = 10000):
+        self.rate, self.burst, self.max_keys = per_minute / 60, burst, max_keys
+        self.buckets: OrderedDict[int, TokenBucket] = OrderedDict()
+    def allow(self, key: int) -> bool:
+        if self.rate <= 0: return True
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = self.buckets[key] = TokenBucket(self.rate, self.burst)
+            if len(self.buckets) > self.max_keys: self.buckets.popitem(last=False)
+        self.buckets.move_to_end(key)
+        return bucket.try_acquire()
+    def refund(self, key: int):
+        """Gives back the token of a request that another limit rejected after all."""
+        bucket = self.buckets.get(key)
+        if bucket is not None: bucket.tokens = min(bucket.capacity, bucket.tokens + 1)
+
+class GeminiBusy(Exception):
+    """The Gemini queue is full; the caller should shed the request."""
+
+class RateLimited(Exception):
+    """The user or group is over its Gemini rate limit."""
+
+class IncompleteAnswer(Exception):
+    """A streamed answer broke off midway. The partial text is already in the chat, but it must not be cached or remembered."""
+    def __init__(self, text: str):
+        super().__init__(f"stream ended after {len(text)} characters")
+        self.text = text
+
+class GeminiScheduler:
+    """Dedicated execution layer for Gemini calls.
+
+    At most `concurrency` calls run at once. Callers beyond that wait in a priority queue of `queue_size`
+    entries (lower number first, FIFO within a priority) and get GeminiBusy once it is full.
+    """
+    def __init__(self, concurrency: int, queue_size: int):
+        self.concurrency, self.queue_size = concurrency, queue_size
+        self.active = 0
+        self.waiters: list[tuple[int, int, asyncio.Future]] = []
+        self._order = itertools.count()
+        self.wait_times = deque(maxlen=1000)
+        self.rejected = 0
+    @property
+    def queue_depth(self) -> int: return len(self.waiters)
+    def average_wait(self) -> float: return sum(self.wait_times) / len(self.wait_times) if self.wait_times else 0.0
+    async def _acquire(self, priority: int):
+        if self.active < self.concurrency and not self.waiters:
+            self.active += 1
+            return
+        if len(self.waiters) >= self.queue_size:
+            self.rejected += 1
+            raise GeminiBusy()
+        entry = (priority, next(self._order), asyncio.get_running_loop().create_future())
+        heapq.heappush(self.waiters, entry)
+        try: await entry[2]
+        except asyncio.CancelledError:
+            if not entry[2].cancelled(): self._release()  # the slot was handed over just before we were cancelled
+            elif entry in self.waiters: self.waiters.remove(entry); heapq.heapify(self.waiters)
+            raise
+    def _release(self):
+        # Hand the slot straight to the next waiter so `active` never dips and lets a newcomer jump the queue
+        while self.waiters:
+            future = heapq.heappop(self.waiters)[2]
+            if not future.done():
+                future.set_result(None)
+                return
+        self.active -= 1
+    @asynccontextmanager
+    async def slot(self, priority: int = 1):
+        started = time.monotonic()
+        await self._acquire(priority)
+        self.wait_times.append(time.monotonic() - started)
+        metrics.observe('gemini_queue_wait_seconds', self.wait_times[-1])
+        try: yield
+        finally: self._release()
+    async def drain(self, timeout: float):
+        """Waits up to `timeout` seconds for running and queued calls to finish."""
+        deadline = time.monotonic() + timeout
+        while (self.active or self.waiters) and time.monotonic() < deadline: await asyncio.sleep(0.1)
+
+RETRYABLE_GEMINI_ERRORS = (asyncio.TimeoutError, google_exceptions.TooManyRequests, google_exceptions.InternalServerError,
+                           google_exceptions.ServiceUnavailable, google_exceptions.DeadlineExceeded)
+
+class GeminiClient:
+    """Async-native Gemini calls on the SDK's shared async client (one connection pool for every request).
+
+    Each request gets a `timeout` deadline, retryable errors are retried up to `max_retries` times with
+    full-jitter exponential backoff, and with `hedge_percentile` set a second identical request is fired
+    when the first outlives that percentile of recent latencies; whichever answers first wins. Streams are
+    hedged the same way on their time to first chunk, and never once a chunk was received.
+    """
+    def __init__(self, model, timeout: float, max_retries: int, base_delay: float, hedge_percentile: float):
+        self.model, self.timeout, self.max_retries, self.base_delay = model, timeout, max_retries, base_delay
+        self.hedge_percentile = hedge_percentile
+        self.latencies = deque(maxlen=200)  # full responses of generate()
+        self.first_chunk_latencies = deque(maxlen=200)  # time to first chunk of stream()
+    def _hedge_delay(self, samples: deque) -> float | None:
+        if not self.hedge_percentile or len(samples) < 20: return None
+        ordered = sorted(samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * self.hedge_percentile / 100))]
+    async def _backoff(self, attempt: int, error: Exception):
+        metrics.inc('gemini_retries_total')
+        delay = random.uniform(0, self.base_delay * 2 ** attempt)
+        logger.warning(f"Gemini call failed ({type(error).__name__}: {error}), retry {attempt + 1} in {delay:.2f}s")
+        await asyncio.sleep(delay)
+    async def _attempt(self, contents):
+        started = time.monotonic()
+        response = await asyncio.wait_for(
+            self.model.generate_content_async(contents, request_options={'timeout': self.timeout}), self.timeout)
+        self.latencies.append(time.monotonic() - started)
+        return response
+    async def _open_stream(self, contents):
+        """Starts a stream and waits for its first chunk; returns (first_chunk, remaining_chunks), or (None, None) if empty."""
+        started = time.monotonic()
+        response = await asyncio.wait_for(self.model.generate_content_async(
+            contents, stream=True, request_options={'timeout': self.timeout}), self.timeout)
+        chunks = response.__aiter__()
+        try: first = await asyncio.wait_for(chunks.__anext__(), self.timeout)
+        except StopAsyncIteration: return None, None
+        except BaseException:
+            await self._close_stream(chunks)  # e.g. the losing copy of a hedged stream being cancelled
+            raise
+        self.first_chunk_latencies.append(time.monotonic() - started)
+        return first, chunks
+    @staticmethod
+    async def _close_stream(chunks):
+        if (aclose := getattr(chunks, 'aclose', None)) is None: return
+        try: await aclose()
+        except Exception as e: logger.warning(f"Failed to close Gemini stream: {e}")
+    async def _hedged(self, attempt, samples: deque, discard=None):
+        """Runs attempt(), and a second copy of it if the first outlives the hedge percentile of samples.
+
+        Whichever copy is not returned is cancelled, or, if it finished too, its result is passed to `discard`.
+        """
+        first = asyncio.ensure_future(attempt())
+        delay = self._hedge_delay(samples)
+        if delay is None: return await first
+        tasks, winner = [first], None
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=delay)
+            if not done:
+                metrics.inc('gemini_hedges_total')
+                tasks.append(asyncio.ensure_future(attempt()))
+            pending, errors = set(tasks), []
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        winner = task
+                        return task.result()
+                    errors.append(task.exception())
+            raise errors[0]
+        finally:
+            for task in tasks:
+                if task is winner: continue
+                if not task.done(): task.cancel()
+                elif discard and not task.cancelled() and task.exception() is None: await discard(task.result())
+    async def generate(self, contents):
+        for attempt in range(self.max_retries + 1):
+            try: return await self._hedged(lambda: self._attempt(contents), self.latencies)
+            except RETRYABLE_GEMINI_ERRORS as e:
+                if attempt == self.max_retries: raise
+                await self._backoff(attempt, e)
+    async def stream(self, contents):
+        """Yields response chunks. Each chunk must arrive within `timeout`; retries stop once one was yielded."""
+        for attempt in range(self.max_retries + 1):
+            yielded, chunks = False, None
+            try:
+                first, chunks = await self._hedged(lambda: self._open_stream(contents), self.first_chunk_latencies,
+                                                   discard=lambda opened: self._close_stream(opened[1]))
+                if first is None: return
+                yielded = True
+                yield first
+                while True:
+                    try: chunk = await asyncio.wait_for(chunks.__anext__(), self.timeout)
+                    except StopAsyncIteration: return
+                    yield chunk
+            except RETRYABLE_GEMINI_ERRORS as e:
+                if yielded or attempt == self.max_retries: raise
+                await self._backoff(attempt, e)
+            finally:
+                if chunks is not None: await self._close_stream(chunks)  # also when the caller stops reading early
+
+gemini_scheduler = GeminiScheduler(GEMINI_CONCURRENCY, GEMINI_QUEUE_SIZE)
+user_rate_limiter = KeyedRateLimiter(GEMINI_USER_RATE, GEMINI_USER_BURST)
+group_rate_limiter = KeyedRateLimiter(GEMINI_GROUP_RATE, GEMINI_GROUP_BURST)
+gemini_client = GeminiClient(gemini_model, GEMINI_TIMEOUT, GEMINI_MAX_RETRIES, GEMINI_RETRY_BASE_DELAY, GEMINI_HEDGE_PERCENTILE)
+
+FENCE = '```'
+
+def _inline_cut(line: str, start: int, room: int, code: bool) -> int:
+    """Where to end a piece of `line` that starts at `start` and may hold `room` characters: after the last
+    space in its second half that leaves no `*`, `_` or `` ` `` span unbalanced (any space inside a code
+    block), else at `start + room`. Only offsets are used, so cutting a huge line never copies its rest."""
+    end = start + room
+    cut = line.rfind(' ', start + room // 2, end)
+    while cut > start and not code:
+        if not any(line.count(marker, start, cut) % 2 for marker in '*_`'): break
+        cut = line.rfind(' ', start + room // 2, cut)
+    return cut + 1 if cut > start else end
+
+def _toggle_spans(spans: str, segment: str) -> str:
+    """The `*`/`_` spans open after `segment`, given those open before it; markers inside `code` don't count."""
+    if '`' in segment: segment = ''.join(segment.split('`')[::2])
+    for marker in '*_':
+        if segment.count(marker) % 2: spans = spans.replace(marker, '') if marker in spans else spans + marker
+    return spans
+
+def split_markdown(text: str, limit: int = MAX_MESSAGE_LENGTH) -> list[str]:
+    """Splits text into parts of at most `limit` characters in a single pass over its lines.
+
+    Parts end on line breaks where possible. A code block cut by a boundary is closed at the end of one part
+    and reopened, language tag included, at the start of the next; so is a `*`/`_` span running across lines.
+    A line longer than a whole part is cut at a space outside inline spans. Each part therefore parses as
+    Markdown on its own.
+    """
+    if len(text) <= limit: return [text]
+    if limit < 2 * len(FENCE) + 3: raise ValueError(f"limit {limit} can't hold a reopened code block")
+    parts, lines, size = [], [], 0
+    fence = None  # opening line of the code block we are in
+    spans = lead = ''  # `*`/`_` spans open at the end of `lines`; `lead` reopens them on the next line
+    def flush():
+        nonlocal lines, size, lead
+        parts.append('\n'.join(lines) + ('\n' + FENCE if fence else spans[::-1]))
+        lines, size, lead = ([fence], len(fence), '') if fence else ([], len(spans), spans)
+    def add(piece: str, separator: int):
+        nonlocal size, lead
+        lines.append(lead + piece if lead else piece)
+        size += separator + len(piece)
+        lead = ''
+    for line in text.split('\n'):
+        stripped = line.lstrip()
+        toggles = stripped.startswith(FENCE) and (fence is not None or FENCE not in stripped[3:])
+        pos = 0
+        while True:
+            separator = 1 if lines else 0
+            free = limit - size - separator
+            if len(line) - pos <= free:
+                rest = line[pos:] if pos else line
+                if toggles: after, after_spans = (None if fence else stripped[:40].rstrip()), ''
+                else: after, after_spans = fence, ('' if fence else _toggle_spans(spans, rest))
+                if len(rest) <= free - (len(FENCE) + 1 if after else len(after_spans)):  # keep space to close them
+                    add(rest, separator)
+                    fence, spans = after, after_spans
+                    break
+            if len(lines) > (1 if fence else 0):
+                flush()
+                continue
+            room = free - (len(FENCE) + 1 if fence else 2)
+            if room < 1:
+                # Only a long language tag on the reopened block can leave no room; reopen it without the tag
+                fence = FENCE
+                lines, size = [fence], len(fence)
+                continue
+            cut = _inline_cut(line, pos, room, fence is not None)
+            piece = line[pos:cut]
+            if not fence: spans = _toggle_spans(spans, piece)
+            add(piece, separator)
+            pos = cut
+            flush()
+    parts.append('\n'.join(lines))
+    return parts
+
+class ChatPacer:
+    """Spaces out consecutive messages to one chat, learning the gap from Telegram's flood control.
+
+    Chats start with no gap. A RetryAfter pauses the chat for the time Telegram asks and doubles its gap
+    (starting from `step`); each successful send shrinks it by 10%, so a chat settles just under its limit.
+    """
+    def __init__(self, step: float = 0.25, max_interval: float = 5.0, max_chats: int = 10000):
+        self.step, self.max_interval, self.max_chats = step, max_interval, max_chats
+        self.chats: OrderedDict[int, list[float]] = OrderedDict()  # chat_id -> [interval, next_send_at]
+    def _state(self, chat_id: int) -> list[float]:
+        state = self.chats.get(chat_id)
+        if state is None:
+            state = self.chats[chat_id] = [0.0, 0.0]
+            if len(self.chats) > self.max_chats: self.chats.popitem(last=False)
+        self.chats.move_to_end(chat_id)
+        return state
+    async def wait(self, chat_id: int):
+        state, now = self._state(chat_id), time.monotonic()
+        delay = state[1] - now
+        state[1] = max(now, state[1]) + state[0]  # reserve the slot so concurrent senders queue up behind it
+        if delay > 0:
+            metrics.observe('telegram_pacing_delay_seconds', delay)
+            await asyncio.sleep(delay)
+    def success(self, chat_id: int):
+        state = self._state(chat_id)
+        state[0] = state[0] * 0.9 if state[0] > self.step / 8 else 0.0
+    def throttle(self, chat_id: int, retry_after: float):
+        state = self._state(chat_id)
+        state[0] = min(self.max_interval, max(self.step, state[0] * 2))
+        state[1] = max(state[1], time.monotonic() + retry_after)
+
+chat_pacer = ChatPacer()
+
+async def send_paced(bot, chat_id: int, text: str, parse_mode: str | None = constants.ParseMode.MARKDOWN, **kwargs):
+    """Sends one message through chat_pacer, retrying on flood control and resending as plain text if the Markdown doesn't parse.
+
+    Only flood waits count against the three attempts; the plain-text resend is extra, so it happens even after two
+    floods. Every path either returns the sent message or raises.
+    """
+    floods = 0
+    while True:
+        await chat_pacer.wait(chat_id)
+        try:
+            with metrics.timer('telegram_request_duration_seconds', method='send_message'):
+                message = await bot.send_message(chat_id=chat_id, text=text, parse_mode=parse_mode, **kwargs)
+            chat_pacer.success(chat_id)
+            return message
+        except RetryAfter as e:
+            metrics.inc('telegram_retries_total', reason='flood_control')
+            chat_pacer.throttle(chat_id, e.retry_after)
+            floods += 1
+            if floods == 3: raise
+        except BadRequest as e:
+            if parse_mode is None or "can't parse" not in str(e).lower(): raise
+            metrics.inc('telegram_markdown_fallbacks_total')
+            parse_mode = None
+
 async def send_long_message(context: ContextTypes.DEFAULT_TYPE, chat_id: int, text: str):
-    MAX_LENGTH = 4000
-    if len(text) <= MAX_LENGTH:
-        await context.bot.send_message(chat_id=chat_id, text=text, parse_mode=constants.ParseMode.MARKDOWN)
-        return
-    parts = []
-    while len(text) > 0:
-        if len(text) > MAX_LENGTH:
-            part = text[:MAX_LENGTH]
-            last_newline = part.rfind('\n')
-            if last_newline != -1:
-                parts.append(part[:last_newline])
-                text = text[last_newline + 1:]
-            else:
-                parts.append(part)
-                text = text[MAX_LENGTH:]
-        else:
-            parts.append(text)
-            break
-    for part in parts:
-        await context.bot.send_message(chat_id=chat_id, text=part, parse_mode=constants.ParseMode.MARKDOWN)
-        await asyncio.sleep(0.5)
-
-async def generate_gemini_response(prompt: str) -> str | None:
-    """Runs the synchronous Gemini API call in a separate thread to avoid blocking."""
-    if not gemini_model: return None
+    for part in split_markdown(text, MAX_MESSAGE_LENGTH):
+        if part.strip(): await send_paced(context.bot, chat_id, part)
+
+async def generate_gemini_response(prompt: str | list[dict], priority: int = 1) -> str | None:
+    """Awaits the Gemini API natively (no thread hop) once the scheduler grants a slot."""
+    if not gemini_client.model: return None
     try:
-        response = await asyncio.to_thread(gemini_model.generate_content, prompt)
+        async with gemini_scheduler.slot(priority):
+            with metrics.timer('gemini_request_duration_seconds', mode='generate'):
+                response = await gemini_client.generate(prompt)
+        record_gemini_usage(response)
+        metrics.inc('gemini_requests_total', mode='generate', outcome='ok' if response.parts else 'safety_block')
         return response.text if response.parts else "" # Return empty string for safety block
+    except GeminiBusy: raise
     except Exception as e:
-        logger.error(f"Gemini API call failed: {e}")
+        logger.error(f"Gemini API call failed: {type(e).__name__}: {e}")
+        metrics.inc('gemini_requests_total', mode='generate', outcome='error')
         return None
 
+class ResponseCache:
+    """LRU cache of Gemini answers with a per-entry TTL, keyed on the model name and normalised prompt.
+
+    `run()` also coalesces concurrent identical prompts: the first caller produces the answer and
+    everyone else awaits the same future. If that producer is cancelled (its chat sent a newer message), rate
+    limited, or its stream broke off, the waiters are not failed with it: one of them takes over and produces the answer
+    itself. Any other error, such as GeminiBusy, is raised in every waiter too. Only real answers are stored,
+    never "" (safety block) or None.
+    """
+    ABANDONED = object()  # in-flight result of a producer whose waiters should try again
+    def __init__(self, max_entries: int, ttl: float, file_path: str = ''):
+        self.max_entries, self.ttl, self.file_path = max_entries, ttl, file_path
+        self.entries: OrderedDict[str, tuple[float, str]] = OrderedDict()  # key -> (expires_at, text)
+        self.inflight: dict[str, asyncio.Future] = {}
+        self.hits = self.misses = self.coalesced = 0
+        if file_path: self._load()
+    def __len__(self): return len(self.entries)
+    @staticmethod
+    def make_key(model_name: str, prompt: str) -> str:
+        normalized = ' '.join(prompt.casefold().split()).rstrip(' ?!.।')
+        return hashlib.sha256(f"{model_name}\0{normalized}".encode('utf-8')).hexdigest()
+    def get(self, key: str) -> str | None:
+        entry = self.entries.get(key)
+        if entry is None: return None
+        if entry[0] < time.time():
+            del self.entries[key]
+            return None
+        self.entries.move_to_end(key)
+        return entry[1]
+    def put(self, key: str, text: str | None):
+        if not text or self.max_entries <= 0: return
+        self.entries[key] = (time.time() + self.ttl, text)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries: self.entries.popitem(last=False)
+    async def run(self, key: str, produce) -> tuple[str | None, bool]:
+        """Returns (text, produced_here); produced_here is False for cache hits and coalesced callers."""
+        if self.max_entries <= 0: return await produce(), True
+        while True:
+            cached = self.get(key)
+            if cached is not None:
+                self.hits += 1
+                return cached, False
+            if key not in self.inflight: break
+            text = await asyncio.shield(self.inflight[key])  # re-raises the producer's error
+            if text is not self.ABANDONED:
+                self.coalesced += 1
+                return text, False
+            # The first waiter to wake finds nothing in flight and becomes the producer; the rest join it
+        self.misses += 1
+        future = self.inflight[key] = asyncio.get_running_loop().create_future()
+        try: text = await produce()
+        except (asyncio.CancelledError, IncompleteAnswer, RateLimited):
+            future.set_result(self.ABANDONED)
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            future.exception()  # mark it retrieved; without waiters nobody else would
+            raise
+        finally: del self.inflight[key]
+        self.put(key, text)
+        future.set_result(text)
+        return text, True
+    def _load(self):
+        try:
+            with open(self.file_path, 'r', encoding='utf-8') as f: entries = json.load(f)
+        except FileNotFoundError: return
+        except (ValueError, OSError) as e:
+            logger.error(f"Failed to load response cache from {self.file_path}: {e}"); return
+        now = time.time()
+        for key, (expires_at, text) in sorted(entries.items(), key=lambda item: item[1][0]):
+            if expires_at > now: self.entries[key] = (expires_at, text)
+        while len(self.entries) > self.max_entries: self.entries.popitem(last=False)
+    def _write(self, entries: dict):
+        tmp_path = self.file_path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f: json.dump(entries, f, ensure_ascii=False, separators=(',', ':'))
+        os.replace(tmp_path, self.file_path)
+    async def save(self):
+        if not self.file_path: return
+        now = time.time()
+        entries = {key: entry for key, entry in self.entries.items() if entry[0] > now}
+        try: await asyncio.to_thread(self._write, entries)
+        except Exception as e: logger.error(f"Failed to save response cache: {e}")
+
+response_cache = ResponseCache(RESPONSE_CACHE_SIZE, RESPONSE_CACHE_TTL, RESPONSE_CACHE_FILE)
+
+class ChatSession:
+    __slots__ = ('turns', 'tokens', 'last_used')
+    def __init__(self, turns=(), last_used: float = 0.0):
+        self.turns: deque[tuple[str, str]] = deque(turns)  # (role, text), oldest first
+        self.tokens = sum(estimate_tokens(text) for _, text in self.turns)
+        self.last_used = last_used
+
+def estimate_tokens(text: str) -> int: return len(text) // 4 + 1
+
+class ConversationMemory:
+    """Recent private-chat turns per user, used as context for the next Gemini call.
+
+    Each session keeps at most `token_budget` (estimated) tokens, dropping the oldest exchanges first.
+    Sessions live in an LRU of `max_sessions` and are evicted after `ttl` seconds of inactivity. With
+    `persist` on, sessions are also written through BotData so they survive restarts.
+    """
+    def __init__(self, token_budget: int, ttl: float, max_sessions: int, persist: bool):
+        self.token_budget, self.ttl, self.max_sessions, self.persist = token_budget, ttl, max_sessions, persist
+        self.sessions: OrderedDict[int, ChatSession] = OrderedDict()
+    def _evict(self):
+        # Every move to the LRU end refreshes last_used, so the head is the longest idle session
+        # and expired sessions are always at the front
+        expired_before = time.time() - self.ttl
+        while self.sessions and (len(self.sessions) > self.max_sessions or next(iter(self.sessions.values())).last_used < expired_before):
+            user_id, session = self.sessions.popitem(last=False)
+            # Sessions pushed out by max_sessions stay persisted and are reloaded on the user's next message
+            if self.persist and session.last_used < expired_before: bot_data.delete_history(user_id)
+    def _session(self, user_id: int) -> ChatSession | None:
+        self._evict()
+        now = time.time()
+        session = self.sessions.get(user_id)
+        if session is not None and session.last_used < now - self.ttl:
+            self.sessions.pop(user_id)
+            if self.persist: bot_data.delete_history(user_id)
+            session = None
+        if session is None and self.persist:
+            stored = bot_data.get_history(user_id)
+            if stored and stored['last_used'] >= now - self.ttl:
+                session = self.sessions[user_id] = ChatSession(map(tuple, stored['turns']), stored['last_used'])
+            elif stored: bot_data.delete_history(user_id)
+        if session is not None:
+            self.sessions.move_to_end(user_id)
+            session.last_used = now
+        return session
+    def contents(self, user_id: int, prompt: str) -> list[dict] | None:
+        """Gemini `contents` for prompt preceded by the user's history, or None when there is no history."""
+        session = self._session(user_id)
+        if not session or not session.turns: return None
+        return [{'role': role, 'parts': [text]} for role, text in session.turns] + [{'role': 'user', 'parts': [prompt]}]
+    def record(self, user_id: int, prompt: str, answer: str):
+        if self.token_budget <= 0: return
+        session = self._session(user_id)
+        if session is None: session = self.sessions[user_id] = ChatSession()
+        for role, text in (('user', prompt), ('model', answer)):
+            session.turns.append((role, text)); session.tokens += estimate_tokens(text)
+        # Drop whole user/model exchanges so the history always starts with a user turn
+        while session.tokens > self.token_budget and len(session.turns) > 2:
+            for _ in range(2): session.tokens -= estimate_tokens(session.turns.popleft()[1])
+        if session.tokens > self.token_budget: session.turns.clear(); session.tokens = 0
+        session.last_used = time.time()
+        if self.persist: bot_data.set_history(user_id, {'last_used': session.last_used, 'turns': list(session.turns)})
+        self._evict()
+    def reset(self, user_id: int):
+        self.sessions.pop(user_id, None)
+        if self.persist: bot_data.delete_history(user_id)
+
+conversation_memory = ConversationMemory(CHAT_HISTORY_TOKENS, CHAT_SESSION_TTL, CHAT_MAX_SESSIONS, CHAT_HISTORY_PERSIST)
+
+class PendingChat:
+    __slots__ = ('messages', 'seq', 'wake', 'generation')
+    def __init__(self):
+        self.messages: list[str] = []  # received but not yet answered, oldest first
+        self.seq = 0
+        self.wake: asyncio.Future | None = None  # resolved when a newer message supersedes the waiting one
+        self.generation: asyncio.Task | None = None
+
+class MessageCoalescer:
+    """Turns a burst of private messages into a single Gemini request per chat.
+
+    Every message restarts a `delay`-second window, and only the handler of the last message in the window
+    goes on to answer, with all pending messages joined into one prompt. A chat has at most one generation
+    running: a newer message cancels it, and its messages stay pending so the next one answers them too.
+    """
+    def __init__(self, delay: float):
+        self.delay = delay
+        self.chats: dict[int, PendingChat] = {}
+        self.coalesced = self.cancelled = 0
+    async def submit(self, chat_id: int, text: str, answer):
+        """Queues text for chat_id; `answer(prompt)` is only awaited by the newest message's handler."""
+        chat = self.chats.setdefault(chat_id, PendingChat())
+        chat.messages.append(text)
+        chat.seq += 1
+        seq = chat.seq
+        if len(chat.messages) > 1: self.coalesced += 1
+        if chat.wake and not chat.wake.done(): chat.wake.set_result(None)  # frees the older handler right away
+        if chat.generation and not chat.generation.done():
+            chat.generation.cancel()
+            self.cancelled += 1
+        chat.wake = wake = asyncio.get_running_loop().create_future()
+        await asyncio.wait([wake], timeout=self.delay)
+        if chat.seq != seq: return
+        if chat.generation: await asyncio.gather(chat.generation, return_exceptions=True)  # let a cancelled one unwind
+        if chat.seq != seq: return
+        batch = len(chat.messages)
+        generation = chat.generation = asyncio.ensure_future(answer('\n'.join(chat.messages)))
+        try: await generation
+        except asyncio.CancelledError:
+            if chat.seq != seq and generation.cancelled(): return  # superseded; the newer handler answers this batch
+            raise
+        finally:
+            if not generation.cancelled(): del chat.messages[:batch]
+            if chat.seq == seq: self.chats.pop(chat_id, None)
+
+message_coalescer = MessageCoalescer(PRIVATE_DEBOUNCE_MS / 1000)
+
+metrics.collect('gemini_active_requests', 'gauge', 'Gemini calls currently running.', lambda: gemini_scheduler.active)
+metrics.collect('gemini_queue_depth', 'gauge', 'Gemini calls waiting for a slot.', lambda: gemini_scheduler.queue_depth)
+metrics.collect('gemini_rejected_total', 'counter', 'Gemini calls shed because the queue was full.', lambda: gemini_scheduler.rejected)
+metrics.collect('response_cache_hits_total', 'counter', 'Answers served from the response cache.', lambda: response_cache.hits)
+metrics.collect('response_cache_misses_total', 'counter', 'Prompts that needed a Gemini call.', lambda: response_cache.misses)
+metrics.collect('response_cache_coalesced_total', 'counter', 'Prompts that joined an identical in-flight call.', lambda: response_cache.coalesced)
+metrics.collect('response_cache_entries', 'gauge', 'Answers currently cached.', lambda: len(response_cache))
+metrics.collect('chat_sessions', 'gauge', 'Conversation sessions held in memory.', lambda: len(conversation_memory.sessions))
+metrics.collect('private_messages_coalesced_total', 'counter', 'Private messages merged into a later prompt.', lambda: message_coalescer.coalesced)
+metrics.collect('private_generations_cancelled_total', 'counter', 'Private answers cancelled by a newer message.', lambda: message_coalescer.cancelled)
+metrics.collect('private_chats_pending', 'gauge', 'Private chats with messages waiting for an answer.', lambda: len(message_coalescer.chats))
+metrics.collect('bot_users', 'gauge', 'Known users.', lambda: bot_data.count_users())
+
+class StreamingReply:
+    """Grows a Telegram message in place as Gemini chunks arrive.
+
+    Intermediate edits are sent as plain text (a half-written reply is rarely valid Markdown), throttled to
+    one per `edit_interval` seconds and skipped while flood control is in effect. Once the text passes
+    MAX_MESSAGE_LENGTH the finished part is queued for its final edit and a new message is started.
+    Only `finish()` waits out flood control or raises send errors, so the caller can release its Gemini slot
+    before calling it.
+    `abandon()` deletes everything sent so far.
+    """
+    def __init__(self, context: ContextTypes.DEFAULT_TYPE, chat_id: int, edit_interval: float):
+        self.bot, self.chat_id, self.edit_interval = context.bot, chat_id, edit_interval
+        self.message = None
+        self.sent = []  # every message of this reply, oldest first
+        self.text = ''
+        self.shown = ''
+        self.finished: deque[str] = deque()  # parts past the length limit still waiting for their final edit
+        self.next_edit_at = self.paused_until = 0.0
+    async def append(self, chunk: str):
+        self.text += chunk
+        if len(self.text) > MAX_MESSAGE_LENGTH:
+            # Same cut points as send_long_message, so an open code block carries over into the next message
+            *done, self.text = split_markdown(self.text, MAX_MESSAGE_LENGTH)
+            self.finished.extend(done)
+        try:
+            if await self._drain(wait=False) and time.monotonic() >= self.next_edit_at: await self._render(self.text)
+        except TelegramError as e:
+            # Frames are cosmetic: skip this one (finished parts stay queued) and keep reading the stream
+            logger.warning(f"Skipped streaming frame in {self.chat_id}: {e}")
+            self.next_edit_at = time.monotonic() + self.edit_interval
+    async def finish(self):
+        await self._drain(wait=True)
+        if self.text: await self._render(self.text, final=True, wait=True)
+    async def abandon(self):
+        self.finished.clear()
+        self.text = ''
+        while self.sent:
+            message = self.sent.pop()
+            try: await message.delete()
+            except TelegramError as e: logger.warning(f"Failed to delete abandoned reply in {self.chat_id}: {e}")
+        self.message = None
+    async def _drain(self, wait: bool) -> bool:
+        while self.finished:
+            if not await self._render(self.finished[0], final=True, wait=wait): return False
+            self.finished.popleft()
+            self.message, self.shown = None, ''
+        return True
+    async def _render(self, text: str, final: bool = False, wait: bool = False) -> bool:
+        """Returns False when flood control held the render back and `wait` is off."""
+        if not text.strip() or (text == self.shown and not final): return True
+        if (delay := self.paused_until - time.monotonic()) > 0:
+            if not wait: return False
+            await asyncio.sleep(delay)
+        parse_mode = constants.ParseMode.MARKDOWN if final else None
+        floods = 0
+        while True:
+            try:
+                if self.message is None:
+                    with metrics.timer('telegram_request_duration_seconds', method='send_message'):
+                        self.message = await self.bot.send_message(chat_id=self.chat_id, text=text, parse_mode=parse_mode)
+                    self.sent.append(self.message)
+                else:
+                    with metrics.timer('telegram_request_duration_seconds', method='edit_message_text'):
+                        await self.message.edit_text(text, parse_mode=parse_mode)
+                break
+            except RetryAfter as e:
+                metrics.inc('telegram_retries_total', reason='flood_control')
+                chat_pacer.throttle(self.chat_id, e.retry_after)
+                self.paused_until = time.monotonic() + e.retry_after
+                # Skipped frames are harmless: the next render carries the accumulated text
+                floods += 1
+                if not wait or floods > 3: return False
+                await asyncio.sleep(e.retry_after)
+            except BadRequest as e:
+                if 'not modified' in str(e).lower(): break
+                if parse_mode is None: raise
+                parse_mode = None  # Gemini's Markdown didn't parse, fall back to plain text
+        self.shown = text
+        self.next_edit_at = time.monotonic() + self.edit_interval
+        return True
+
+async def _timed_chunks(stream, waited: list[float]):
+    """Yields the stream's chunks, adding the time spent waiting for each one to `waited[0]`."""
+    chunks = stream.__aiter__()
+    while True:
+        started = time.monotonic()
+        try: chunk = await chunks.__anext__()
+        except StopAsyncIteration: return
+        finally: waited[0] += time.monotonic() - started
+        yield chunk
+
+async def stream_gemini_response(context: ContextTypes.DEFAULT_TYPE, chat_id: int, prompt: str | list[dict], edit_interval: float, priority: int = 1) -> str | None:
+    """Streams a Gemini answer straight into the chat; returns the full text, "" for a safety block or None on failure.
+
+    If the stream fails after some text was shown, that text is finalised in the chat and IncompleteAnswer is raised.
+    If the call is cancelled (a newer message superseded the prompt), whatever was shown is deleted again.
+    """
+    if not gemini_client.model: return None
+    reply = StreamingReply(context, chat_id, edit_interval)
+    try: return await _stream_into(reply, prompt, priority)
+    except asyncio.CancelledError:
+        metrics.inc('gemini_requests_total', mode='stream', outcome='cancelled')
+        # Shielded so that yet another newer message can't leave the half-written reply behind
+        await asyncio.shield(reply.abandon())
+        raise
+
+async def _stream_into(reply: StreamingReply, prompt: str | list[dict], priority: int) -> str | None:
+    chat_id = reply.chat_id
+    ttft, parts, last_chunk, outcome = None, [], None, 'ok'
+    waited = [0.0]  # time spent on Gemini alone, without the Telegram sends and edits in between chunks
+    async with gemini_scheduler.slot(priority):
+        started = time.monotonic()
+        try:
+            async for chunk in _timed_chunks(gemini_client.stream(prompt), waited):
+                last_chunk = chunk
+                if not chunk.parts: continue
+                if ttft is None:
+                    ttft = time.monotonic() - started
+                    metrics.observe('gemini_ttft_seconds', ttft)
+                parts.append(chunk.text)
+                await reply.append(chunk.text)
+        except Exception as e:
+            logger.error(f"Gemini streaming call failed: {e}")
+            metrics.inc('gemini_requests_total', mode='stream', outcome='error')
+            if not parts: return None
+            outcome = None  # the user already sees a partial answer, so keep it rather than reporting an error
+    total = time.monotonic() - started
+    # The final Markdown edits may have to wait out flood control, so they run after the slot is released
+    try: await reply.finish()
+    except Exception as e: logger.error(f"Failed to finalise streamed reply in {chat_id}: {e}")
+    metrics.observe('gemini_request_duration_seconds', waited[0], mode='stream')
+    record_gemini_usage(last_chunk)  # the final chunk carries the usage totals for the whole stream
+    if outcome: metrics.inc('gemini_requests_total', mode='stream', outcome=outcome if parts else 'safety_block')
+    logger.info(f"Gemini stream chat={chat_id} ttft={'-' if ttft is None else f'{ttft * 1000:.0f}ms'} gemini={waited[0] * 1000:.0f}ms total={total * 1000:.0f}ms chars={sum(map(len, parts))}")
+    if outcome is None: raise IncompleteAnswer(''.join(parts))
+    return ''.join(parts)
+
+def gemini_allowed(user_id: int, chat_id: int, private: bool) -> bool:
+    """Spends a token from the group's bucket and then the user's; a rejection by either charges neither."""
+    if is_admin(user_id): return True
+    if not private and not group_rate_limiter.allow(chat_id): return False
+    if user_rate_limiter.allow(user_id): return True
+    if not private: group_rate_limiter.refund(chat_id)
+    return False
+
+async def answer_with_gemini(update: Update, context: ContextTypes.DEFAULT_TYPE, prompt: str, contents: list[dict] | None = None) -> str | None:
+    """Replies to prompt in the current chat and returns Gemini's answer. `contents`, when given, is sent instead of
+    the bare prompt (e.g. with conversation history) and bypasses the response cache."""
+    user_id, chat = update.effective_user.id, update.effective_chat
+    private = chat.type == 'private'
+    async def notice(key: str):
+        # Status replies share the chat's pacing; like reply_text, they only quote the question in groups
+        await send_paced(context.bot, chat.id, get_text(user_id, key), None, reply_to_message_id=None if private else update.message.message_id)
+    # Private chats and the admin jump ahead of group traffic in the Gemini queue
+    priority = 0 if private or is_admin(user_id) else 1
+    await context.bot.send_chat_action(chat_id=chat.id, action=constants.ChatAction.TYPING)
+    async def produce() -> str | None:
+        # Only calls that reach Gemini are rate limited; cache hits and prompts coalesced onto another call are free
+        if not gemini_allowed(user_id, chat.id, private): raise RateLimited()
+        if not STREAM_RESPONSES: return await generate_gemini_response(contents or prompt, priority)
+        edit_interval = STREAM_EDIT_INTERVAL if private else STREAM_GROUP_EDIT_INTERVAL
+        return await stream_gemini_response(context, chat.id, contents or prompt, edit_interval, priority)
+    try:
+        if contents: response_text, produced_here = await produce(), True
+        else: response_text, produced_here = await response_cache.run(ResponseCache.make_key(GEMINI_MODEL, prompt), produce)
+    except RateLimited:
+        await notice('rate_limited'); return None
+    except GeminiBusy:
+        metrics.inc('gemini_requests_total', mode='stream' if STREAM_RESPONSES else 'generate', outcome='busy')
+        await notice('busy'); return None
+    except IncompleteAnswer:
+        return None  # the partial answer is already in the chat; it is neither cached nor remembered
+    # A streamed answer is already in this chat; cached or shared answers still have to be sent
+    if response_text and not (produced_here and STREAM_RESPONSES):
+        await send_long_message(context, chat.id, response_text)
+
+    if response_text == "":
+        await notice('safety_block')
+    elif response_text is None:
+        await notice('api_error')
+    return response_text
+
+# --- ব্রডকাস্ট ইঞ্জিন ---
+class BroadcastJob:
+    """Sends one message to every user from a background task.
+
+    Users are walked in id order in batches of BROADCAST_BATCH_SIZE, with BROADCAST_CONCURRENCY senders
+    sharing a global token bucket. Each user gets a single message, so Telegram's per-chat limit never
+    binds; the global rate is halved on RetryAfter and creeps back up on success. The cursor and counters
+    are written to BROADCAST_STATE_FILE after every batch, and when the job is cancelled at shutdown, so a
+    restart resumes where it stopped. At most the BROADCAST_CONCURRENCY sends in flight get repeated.
+    """
+    def __init__(self, state: dict):
+        self.state = state
+        self.limiter = TokenBucket(BROADCAST_RATE, max(1.0, BROADCAST_RATE))
+        self.paused_until = 0.0
+        self.last_progress = 0.0
+    @classmethod
+    def create(cls, message: str, chat_id: int, message_id: int) -> 'BroadcastJob':
+        return cls({'message': message, 'chat_id': chat_id, 'message_id': message_id, 'cursor': None,
+                    'total': bot_data.count_users(), 'done': 0, 'sent': 0, 'failed': 0, 'pruned': 0, 'elapsed': 0.0})
+    @classmethod
+    def load(cls) -> 'BroadcastJob | None':
+        try:
+            with open(BROADCAST_STATE_FILE, 'r', encoding='utf-8') as f: return cls(json.load(f))
+        except FileNotFoundError: return None
+        except (ValueError, OSError) as e:
+            logger.error(f"Ignoring unreadable broadcast state {BROADCAST_STATE_FILE}: {e}"); return None
+    def _write_state(self, state: dict):
+        tmp_path = BROADCAST_STATE_FILE + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f: json.dump(state, f, ensure_ascii=False)
+        os.replace(tmp_path, BROADCAST_STATE_FILE)
+    async def save(self): await asyncio.to_thread(self._write_state, dict(self.state))
+    def _stats(self, elapsed: float) -> dict:
+        fields = {key: self.state[key] for key in ('done', 'total', 'sent', 'failed', 'pruned')}
+        return fields | {'elapsed': elapsed, 'rate': self.state['done'] / elapsed if elapsed > 0 else 0.0}
+    async def _report(self, bot, key: str, elapsed: float):
+        try:
+            await bot.edit_message_text(chat_id=self.state['chat_id'], message_id=self.state['message_id'],
+                                        text=get_text(ADMIN_ID, key, **self._stats(elapsed)), parse_mode=constants.ParseMode.MARKDOWN)
+        except TelegramError as e: logger.warning(f"Failed to update broadcast progress: {e}")
+    def _prune(self, user_id: int):
+        metrics.inc('broadcast_messages_total', result='pruned')
+        bot_data.remove_user(user_id)
+        self.state['pruned'] += 1
+    def _fail(self, user_id: int, error):
+        logger.error(f"Broadcast failed for user {user_id}: {error}")
+        metrics.inc('broadcast_messages_total', result='failed')
+        self.state['failed'] += 1
+    async def _deliver(self, bot, user_id: int):
+        for attempt in range(5):
+            if (delay := self.paused_until - time.monotonic()) > 0: await asyncio.sleep(delay)
+            await self.limiter.acquire()
+            try:
+                with metrics.timer('telegram_request_duration_seconds', method='broadcast'):
+                    await bot.send_message(chat_id=user_id, text=self.state['message'])
+                self.state['sent'] += 1
+                metrics.inc('broadcast_messages_total', result='sent')
+                self.limiter.rate = min(BROADCAST_RATE, self.limiter.rate + 0.1)
+                return
+            except RetryAfter as e:
+                metrics.inc('telegram_retries_total', reason='flood_control')
+                # Concurrent senders all get a RetryAfter from the same burst; only the first one halves the rate
+                if self.paused_until <= time.monotonic():
+                    self.limiter.rate = max(1.0, self.limiter.rate / 2)
+                    logger.warning(f"Broadcast hit flood control, pausing {e.retry_after}s and slowing to {self.limiter.rate:.1f} msg/s")
+                self.paused_until = max(self.paused_until, time.monotonic() + e.retry_after)
+            except Forbidden:
+                # The user blocked the bot or deleted the account; nothing will ever get through again
+                self._prune(user_id)
+                return
+            except BadRequest as e:
+                if 'chat not found' in str(e).lower(): self._prune(user_id)
+                else: self._fail(user_id, e)
+                return
+            except NetworkError as e:
+                metrics.inc('telegram_retries_total', reason='network')
+                logger.warning(f"Broadcast to {user_id} failed ({e}), retrying")
+                await asyncio.sleep(2 ** attempt)
+            except TelegramError as e:
+                self._fail(user_id, e)
+                return
+        self._fail(user_id, "gave up after repeated flood control or network errors")
+    async def run(self, bot):
+        started = time.monotonic() - self.state['elapsed']
+        while batch := bot_data.user_batch(self.state['cursor'], BROADCAST_BATCH_SIZE):
+            pending, finished, completed = iter(enumerate(batch)), [False] * len(batch), 0
+            async def sender():
+                nonlocal completed
+                for index, user_id in pending:
+                    await self._deliver(bot, user_id)
+                    finished[index] = True
+                    while completed < len(batch) and finished[completed]: completed += 1  # users all done up to here
+            try: await asyncio.gather(*(sender() for _ in range(BROADCAST_CONCURRENCY)))
+            except asyncio.CancelledError:
+                # Shutdown or redeploy: keep the finished head of the batch so a resume doesn't message it again
+                if completed: self.state['cursor'], self.state['done'] = batch[completed - 1], self.state['done'] + completed
+                self.state['elapsed'] = time.monotonic() - started
+                await self.save()
+                raise
+            self.state['cursor'], self.state['done'] = batch[-1], self.state['done'] + len(batch)
+            self.state['elapsed'] = time.monotonic() - started
+            await self.save()
+            if time.monotonic() - self.last_progress >= BROADCAST_PROGRESS_INTERVAL:
+                self.last_progress = time.monotonic()
+                await self._report(bot, 'broadcast_progress', self.state['elapsed'])
+        elapsed = time.monotonic() - started
+        try: await asyncio.to_thread(os.remove, BROADCAST_STATE_FILE)
+        except FileNotFoundError: pass
+        logger.info(f"Broadcast finished: {self._stats(elapsed)}")
+        await self._report(bot, 'broadcast_sent', elapsed)
+
+broadcast_task: asyncio.Task | None = None
+
+def broadcast_running() -> bool: return broadcast_task is not None and not broadcast_task.done()
+def start_broadcast(job: BroadcastJob, bot):
+    global broadcast_task
+    broadcast_task = start_background_task(job.run(bot))
+
 # --- ইউজার কমান্ড হ্যান্ডলার ---
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
@@ -159,6 +1488,11 @@ async def about_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     if bot_data.is_user_banned(user_id): return
     await update.message.reply_text(get_text(user_id, 'about_text'), parse_mode=constants.ParseMode.MARKDOWN)
+async def reset_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+    if bot_data.is_user_banned(user_id): return
+    conversation_memory.reset(user_id)
+    await update.message.reply_text(get_text(user_id, 'session_reset'))
 
 # --- অ্যাডমিন কমান্ড হ্যান্ডলার ---
 async def admin_check(update: Update, context: ContextTypes.DEFAULT_TYPE) -> bool:
@@ -188,7 +1522,7 @@ async def removegroup(update: Update, context: ContextTypes.DEFAULT_TYPE):
     except ValueError: await update.message.reply_text("Invalid Group ID.")
 async def listgroups(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not await admin_check(update, context): return
-    groups = bot_data.data['authorized_group_ids']
+    groups = bot_data.list_groups()
     if not groups: await update.message.reply_text(get_text(update.effective_user.id, 'no_groups')); return
     await update.message.reply_text(get_text(update.effective_user.id, 'group_list', count=len(groups), groups="\n".join(map(str, groups))))
 async def ban(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -209,22 +1543,32 @@ async def unban(update: Update, context: ContextTypes.DEFAULT_TYPE):
     except ValueError: await update.message.reply_text("Invalid User ID.")
 async def listbanned(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not await admin_check(update, context): return
-    users = bot_data.data['banned_user_ids']
+    users = bot_data.list_banned()
     if not users: await update.message.reply_text(get_text(update.effective_user.id, 'no_banned')); return
     await update.message.reply_text(get_text(update.effective_user.id, 'banned_list', count=len(users), users="\n".join(map(str, users))))
 async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not await admin_check(update, context): return
     await update.message.reply_text(get_text(update.effective_user.id, 'stats_text',
-        users=len(bot_data.data['all_users']),
-        groups=len(bot_data.data['authorized_group_ids']),
-        banned=len(bot_data.data['banned_user_ids'])))
+        users=bot_data.count_users(),
+        groups=bot_data.count_groups(),
+        banned=bot_data.count_banned(),
+        cache_size=len(response_cache), cache_hits=response_cache.hits,
+        cache_misses=response_cache.misses, cache_coalesced=response_cache.coalesced,
+        gemini_active=gemini_scheduler.active, gemini_concurrency=gemini_scheduler.concurrency,
+        gemini_queued=gemini_scheduler.queue_depth, gemini_wait_ms=gemini_scheduler.average_wait() * 1000,
+        gemini_rejected=gemini_scheduler.rejected))
+async def perf(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not await admin_check(update, context): return
+    lines = metrics.summary()
+    if not lines: await update.message.reply_text(get_text(update.effective_user.id, 'perf_empty')); return
+    await update.message.reply_text(get_text(update.effective_user.id, 'perf_text', lines='\n'.join(lines)), parse_mode=constants.ParseMode.MARKDOWN)
 async def broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not await admin_check(update, context): return
     message_to_send = " ".join(context.args)
     if not message_to_send: await update.message.reply_text(get_text(update.effective_user.id, 'usage_error', command='/broadcast <message>')); return
     context.user_data['broadcast_message'] = message_to_send
     keyboard = [[InlineKeyboardButton("Yes, Send", callback_data='broadcast_confirm_yes'), InlineKeyboardButton("No, Cancel", callback_data='broadcast_confirm_no')]]
-    await update.message.reply_text(get_text(update.effective_user.id, 'broadcast_confirm', count=len(bot_data.data['all_users']), message=message_to_send), reply_markup=InlineKeyboardMarkup(keyboard))
+    await update.message.reply_text(get_text(update.effective_user.id, 'broadcast_confirm', count=bot_data.count_users(), message=message_to_send), reply_markup=InlineKeyboardMarkup(keyboard))
 
 # --- গ্রুপ এবং ব্যক্তিগত চ্যাটের জন্য হ্যান্ডলার ---
 async def ask_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -234,32 +1578,16 @@ async def ask_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not context.args:
         await update.message.reply_text(get_text(user_id, 'usage_error', command='/ask <your question>'))
         return
-    question = " ".join(context.args)
-    
-    await context.bot.send_chat_action(chat_id=chat.id, action=constants.ChatAction.TYPING)
-    response_text = await generate_gemini_response(question)
-    
-    if response_text is not None and response_text != "":
-        await send_long_message(context, chat.id, response_text)
-    elif response_text == "":
-        await update.message.reply_text(get_text(user_id, 'safety_block'))
-    else:
-        await update.message.reply_text(get_text(user_id, 'api_error'))
+    await answer_with_gemini(update, context, " ".join(context.args))
 
 async def handle_private_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user_id, chat_id = update.effective_user.id, update.effective_chat.id
+    user_id = update.effective_user.id
     if bot_data.is_user_banned(user_id): return
     bot_data.add_user(user_id)
-
-    await context.bot.send_chat_action(chat_id=chat_id, action=constants.ChatAction.TYPING)
-    response_text = await generate_gemini_response(update.message.text)
-    
-    if response_text is not None and response_text != "":
-        await send_long_message(context, chat_id, response_text)
-    elif response_text == "":
-        await update.message.reply_text(get_text(user_id, 'safety_block'))
-    else:
-        await update.message.reply_text(get_text(user_id, 'api_error'))
+    async def answer(prompt: str):
+        response_text = await answer_with_gemini(update, context, prompt, conversation_memory.contents(user_id, prompt))
+        if response_text: conversation_memory.record(user_id, prompt, response_text)
+    await message_coalescer.submit(update.effective_chat.id, update.message.text, answer)
 
 # --- অন্যান্য হ্যান্ডলার ---
 async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -276,13 +1604,13 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await query.edit_message_text(get_text(user_id, 'language_updated', lang=lang_name))
     elif data == 'broadcast_confirm_yes':
         if not is_admin(user_id): return
-        message = context.user_data.get('broadcast_message')
+        message = context.user_data.pop('broadcast_message', None)
         if not message: await query.edit_message_text("Error: Message not found."); return
-        sent_count = 0
-        for uid in bot_data.data['all_users']:
-            try: await context.bot.send_message(chat_id=uid, text=message); sent_count += 1
-            except Exception as e: logger.error(f"Broadcast failed for user {uid}: {e}")
-        await query.edit_message_text(get_text(user_id, 'broadcast_sent', count=sent_count))
+        if broadcast_running(): await query.edit_message_text(get_text(user_id, 'broadcast_running')); return
+        job = BroadcastJob.create(message, query.message.chat_id, query.message.message_id)
+        await query.edit_message_text(get_text(user_id, 'broadcast_started', count=job.state['total']))
+        await job.save()
+        start_broadcast(job, context.bot)
     elif data == 'broadcast_confirm_no':
         if not is_admin(user_id): return
         await query.edit_message_text(get_text(user_id, 'broadcast_cancelled'))
@@ -296,41 +1624,218 @@ async def bot_added_to_group(update: Update, context: ContextTypes.DEFAULT_TYPE)
                     await context.bot.leave_chat(chat_id)
                 except Exception as e: logger.error(f"Error leaving unauthorized group {chat_id}: {e}")
 
+# --- HTTP সার্ভার (ওয়েবহুক ও হেলথ চেক) ---
+class HttpServer:
+    """Small asyncio HTTP/1.1 server for the webhook, health and metrics endpoints, so no web framework is needed.
+
+    Handlers are registered per (method, path) and receive (headers, body); they return (status, content_type, body).
+    It faces the internet in webhook mode, so every request (and every idle keep-alive wait) must arrive within
+    HTTP_READ_TIMEOUT seconds, and header lines, header count and body size are capped.
+    """
+    def __init__(self, host: str, port: int):
+        self.host, self.port = host, port
+        self.routes = {}
+        self.server: asyncio.AbstractServer | None = None
+        self.connections: set[asyncio.StreamWriter] = set()
+    def route(self, method: str, path: str, handler): self.routes[(method, path)] = handler
+    async def start(self):
+        self.server = await asyncio.start_server(self._serve, self.host, self.port, limit=HTTP_MAX_LINE)
+        logger.info(f"HTTP server listening on {self.host}:{self.port}")
+    async def stop(self):
+        if not self.server: return
+        self.server.close()
+        for writer in list(self.connections): writer.close()  # idle keep-alive connections would block wait_closed
+        await self.server.wait_closed()
+        self.server = None
+    async def _respond(self, method: str, path: str, headers: dict, body: bytes) -> tuple[int, str, bytes]:
+        handler = self.routes.get((method, path))
+        if handler is None:
+            return (405 if any(p == path for _, p in self.routes) else 404), 'text/plain', b''
+        try: return await handler(headers, body)
+        except Exception as e:
+            logger.error(f"HTTP handler for {method} {path} failed: {e}")
+            return 500, 'text/plain', b''
+    @staticmethod
+    async def _read_request(reader: asyncio.StreamReader) -> tuple | None:
+        """(method, target, version, headers, body) of the next request, body None if too large; None at EOF."""
+        request_line = await reader.readline()
+        if not request_line: return None
+        method, target, version = request_line.decode('latin-1').split()
+        headers = {}
+        while (line := await reader.readline()) not in (b'\r\n', b'\n', b''):
+            if len(headers) >= HTTP_MAX_HEADERS: raise ValueError("too many headers")
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+        length = int(headers.get('content-length', 0))
+        if length > HTTP_MAX_BODY: return method, target, version, headers, None
+        return method, target, version, headers, await reader.readexactly(length) if length else b''
+    async def _serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.connections.add(writer)
+        try:
+            while request := await asyncio.wait_for(self._read_request(reader), HTTP_READ_TIMEOUT):
+                method, target, version, headers, body = request
+                if body is None:
+                    status, content_type, payload, keep_alive = 413, 'text/plain', b'', False
+                else:
+                    status, content_type, payload = await self._respond(method, target.split('?', 1)[0], headers, body)
+                    keep_alive = version == 'HTTP/1.1' and headers.get('connection', '').lower() != 'close'
+                writer.write((f"HTTP/1.1 {status} {HTTPStatus(status).phrase}\r\nContent-Type: {content_type}\r\n"
+                              f"Content-Length: {len(payload)}\r\nConnection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n").encode('latin-1') + payload)
+                await writer.drain()
+                if not keep_alive: break
+        except (ValueError, asyncio.IncompleteReadError, ConnectionError, asyncio.TimeoutError): pass
+        finally:
+            self.connections.discard(writer)
+            writer.close()
+
+def parse_update(body: bytes, bot) -> Update | None:
+    """The Update in a webhook body, or None when the body is not a JSON update object."""
+    try: data = json.loads(body)
+    except ValueError: return None
+    if not isinstance(data, dict): return None
+    try: return Update.de_json(data, bot)
+    except (TypeError, ValueError, KeyError, AttributeError): return None
+
+def webhook_authorized(headers: dict) -> bool:
+    """Whether the request carries WEBHOOK_SECRET in Telegram's secret token header."""
+    # Compared as bytes: compare_digest raises TypeError on non-ASCII str, and headers are decoded as latin-1
+    token = headers.get('x-telegram-bot-api-secret-token', '').encode('latin-1')
+    return hmac.compare_digest(token, WEBHOOK_SECRET.encode('utf-8'))
+
+async def run_webhook(application: Application):
+    """Webhook mode: updates are POSTed to WEBHOOK_PATH and fed to the application's update queue.
+
+    GET /healthz is a liveness probe; GET /readyz only returns 200 while updates are being accepted.
+    On SIGTERM/SIGINT the server stops accepting updates, in-flight work drains for up to
+    SHUTDOWN_GRACE_PERIOD seconds, and then the application and BotData are shut down.
+    """
+    ready = False
+    async def webhook(headers: dict, body: bytes):
+        if not webhook_authorized(headers):
+            return 403, 'text/plain', b''
+        if not ready: return 503, 'text/plain', b''
+        update = parse_update(body, application.bot)
+        if update is None: return 400, 'text/plain', b''
+        await application.update_queue.put(update)
+        return 200, 'text/plain', b''
+    async def healthz(headers: dict, body: bytes): return 200, 'text/plain', b'ok'
+    async def readyz(headers: dict, body: bytes): return (200, 'text/plain', b'ready') if ready else (503, 'text/plain', b'not ready')
+
+    server = HttpServer(WEBHOOK_LISTEN, WEBHOOK_PORT)
+    server.route('POST', WEBHOOK_PATH, webhook)
+    server.route('GET', '/healthz', healthz)
+    server.route('GET', '/readyz', readyz)
+    await server.start()  # health checks answer while the bot is still starting up
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try: loop.add_signal_handler(sig, stop.set)
+        except NotImplementedError: pass  # Windows: Ctrl+C raises KeyboardInterrupt instead
+
+    await application.initialize()
+    await post_init(application)
+    await application.start()
+    try:
+        if WEBHOOK_URL:
+            await application.bot.set_webhook(url=WEBHOOK_URL.rstrip('/') + WEBHOOK_PATH, secret_token=WEBHOOK_SECRET,
+                                              allowed_updates=Update.ALL_TYPES)
+        ready = True
+        logger.info(f"Bot running in webhook mode on {WEBHOOK_PATH}")
+        await stop.wait()
+    finally:
+        ready = False
+        logger.info("Shutting down: draining in-flight updates")
+        await server.stop()
+        deadline = time.monotonic() + SHUTDOWN_GRACE_PERIOD
+        while not application.update_queue.empty() and time.monotonic() < deadline: await asyncio.sleep(0.1)
+        await gemini_scheduler.drain(max(0.0, deadline - time.monotonic()))
+        await application.stop()
+        await application.shutdown()
+        await post_shutdown(application)
+
 # --- মূল ফাংশন ---
-def main():
-    token = os.getenv('TELEGRAM_BOT_TOKEN')
-    if not all([token, ADMIN_ID, GEMINI_API_KEY]):
-        logger.critical("FATAL ERROR: Required environment variables are missing!"); return
-    application = Application.builder().token(token).build()
+background_tasks: set[asyncio.Task] = set()
+metrics_server: HttpServer | None = None
+
+def start_background_task(coro) -> asyncio.Task:
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
+async def serve_metrics(headers: dict, body: bytes):
+    return 200, 'text/plain; version=0.0.4; charset=utf-8', metrics.render().encode('utf-8')
+
+async def post_init(application: Application):
+    start_background_task(storage_maintenance())
+    if METRICS_PORT:
+        global metrics_server
+        metrics_server = HttpServer(METRICS_LISTEN, METRICS_PORT)
+        metrics_server.route('GET', '/metrics', serve_metrics)
+        await metrics_server.start()
+    job = BroadcastJob.load()
+    if job:
+        logger.info(f"Resuming interrupted broadcast after user {job.state['cursor']}")
+        start_broadcast(job, application.bot)
+async def post_shutdown(application: Application):
+    await gemini_scheduler.drain(SHUTDOWN_GRACE_PERIOD)
+    if metrics_server: await metrics_server.stop()
+    for task in list(background_tasks): task.cancel()
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+    background_tasks.clear()
+    await bot_data.close()
+    await response_cache.save()
+
+def build_application(token: str, base_url: str | None = None) -> Application:
+    """Creates the Application with every handler registered; `base_url` points it at another Bot API server."""
+    # Updates are handled concurrently so one slow Gemini answer doesn't hold up every other chat
+    builder = Application.builder().token(token).concurrent_updates(UPDATE_CONCURRENCY if UPDATE_CONCURRENCY > 1 else False)
+    if base_url: builder = builder.base_url(base_url)
+    application = builder.post_init(post_init).post_shutdown(post_shutdown).build()
     
     # ইউজার কমান্ড
-    application.add_handler(CommandHandler('start', start))
-    application.add_handler(CommandHandler('language', language_command))
-    application.add_handler(CommandHandler('help', help_command))
-    application.add_handler(CommandHandler('myinfo', myinfo_command))
-    application.add_handler(CommandHandler('about', about_command))
+    application.add_handler(CommandHandler('start', instrumented('start', start)))
+    application.add_handler(CommandHandler('language', instrumented('language', language_command)))
+    application.add_handler(CommandHandler('help', instrumented('help', help_command)))
+    application.add_handler(CommandHandler('myinfo', instrumented('myinfo', myinfo_command)))
+    application.add_handler(CommandHandler('about', instrumented('about', about_command)))
+    application.add_handler(CommandHandler('reset', instrumented('reset', reset_command)))
 
     # অ্যাডমিন কমান্ড
-    application.add_handler(CommandHandler('admin', admin_command))
-    application.add_handler(CommandHandler('addgroup', addgroup))
-    application.add_handler(CommandHandler('removegroup', removegroup))
-    application.add_handler(CommandHandler('listgroups', listgroups))
-    application.add_handler(CommandHandler('ban', ban))
-    application.add_handler(CommandHandler('unban', unban))
-    application.add_handler(CommandHandler('listbanned', listbanned))
-    application.add_handler(CommandHandler('broadcast', broadcast))
-    application.add_handler(CommandHandler('stats', stats))
+    application.add_handler(CommandHandler('admin', instrumented('admin', admin_command)))
+    application.add_handler(CommandHandler('addgroup', instrumented('addgroup', addgroup)))
+    application.add_handler(CommandHandler('removegroup', instrumented('removegroup', removegroup)))
+    application.add_handler(CommandHandler('listgroups', instrumented('listgroups', listgroups)))
+    application.add_handler(CommandHandler('ban', instrumented('ban', ban)))
+    application.add_handler(CommandHandler('unban', instrumented('unban', unban)))
+    application.add_handler(CommandHandler('listbanned', instrumented('listbanned', listbanned)))
+    application.add_handler(CommandHandler('broadcast', instrumented('broadcast', broadcast)))
+    application.add_handler(CommandHandler('stats', instrumented('stats', stats)))
+    application.add_handler(CommandHandler('perf', instrumented('perf', perf)))
 
     # গ্রুপে ব্যবহারের জন্য বিশেষ কমান্ড
-    application.add_handler(CommandHandler('ask', ask_command))
+    application.add_handler(CommandHandler('ask', instrumented('ask', ask_command)))
     
     # শুধুমাত্র ব্যক্তিগত চ্যাটের মেসেজ হ্যান্ডেল করার জন্য
-    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND & filters.ChatType.PRIVATE, handle_private_message))
+    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND & filters.ChatType.PRIVATE, instrumented('private_message', handle_private_message)))
     
     # অন্যান্য হ্যান্ডলার
-    application.add_handler(CallbackQueryHandler(button_callback))
-    application.add_handler(MessageHandler(filters.StatusUpdate.NEW_CHAT_MEMBERS, bot_added_to_group))
+    application.add_handler(CallbackQueryHandler(instrumented('button_callback', button_callback)))
+    application.add_handler(MessageHandler(filters.StatusUpdate.NEW_CHAT_MEMBERS, instrumented('new_chat_members', bot_added_to_group)))
+    return application
 
+def main():
+    token = os.getenv('TELEGRAM_BOT_TOKEN')
+    if not all([token, ADMIN_ID, GEMINI_API_KEY]):
+        logger.critical("FATAL ERROR: Required environment variables are missing!"); return
+    if BOT_MODE == 'webhook' and not WEBHOOK_SECRET:
+        # Without it anyone who finds the URL could POST forged updates, e.g. admin commands
+        logger.critical("FATAL ERROR: WEBHOOK_SECRET is required in webhook mode!"); return
+    application = build_application(token)
+    if BOT_MODE == 'webhook':
+        asyncio.run(run_webhook(application))
+        return
     logger.info("Bot starting with non-blocking API calls and final features...")
     application.run_polling()
 
@@ -0,0 +1,54 @@
+import os
+import sys
+import tempfile
+
+# bot.py reads its configuration and opens BotData at import time, so point it at a scratch directory first
+_workdir = tempfile.mkdtemp(prefix='gembot-tests-')
+os.environ.setdefault('GEMINI_API_KEY', 'test')
+os.environ.setdefault('DATA_FILE', os.path.join(_workdir, 'data.json'))
+os.environ.setdefault('SQLITE_FILE', os.path.join(_workdir, 'data.db'))
+os.environ.setdefault('BROADCAST_STATE_FILE', os.path.join(_workdir, 'broadcast_state.json'))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import asyncio
+import itertools
+from types import SimpleNamespace
+
+import pytest
+
+class FakeMessage:
+    def __init__(self, bot, chat_id: int, message_id: int, text: str):
+        self.bot, self.chat_id, self.message_id, self.text = bot, chat_id, message_id, text
+    async def edit_text(self, text: str, parse_mode=None):
+        if self.bot.fail: raise self.bot.fail.pop(0)
+        self.text = text
+        self.bot.calls.append(('edit', self.chat_id, text))
+    async def delete(self):
+        self.bot.messages.pop(self.message_id, None)
+        self.bot.calls.append(('delete', self.chat_id, self.message_id))
+
+class FakeBot:
+    """Records what a handler sends instead of calling the Bot API; `fail` can raise on the next sends."""
+    def __init__(self):
+        self.calls, self.messages, self.fail = [], {}, []
+        self.latency = 0.0
+        self._ids = itertools.count(1)
+    async def send_message(self, chat_id: int, text: str, parse_mode=None, **kwargs):
+        if self.latency: await asyncio.sleep(self.latency)
+        if self.fail: raise self.fail.pop(0)
+        message = FakeMessage(self, chat_id, next(self._ids), text)
+        self.messages[message.message_id] = message
+        self.calls.append(('send', chat_id, text, parse_mode))
+        return message
+    async def send_chat_action(self, chat_id: int, action):
+        self.calls.append(('action', chat_id))
+    async def edit_message_text(self, text: str, chat_id: int, message_id: int, parse_mode=None):
+        self.calls.append(('edit', chat_id, text))
+
+@pytest.fixture
+def fake_bot():
+    return FakeBot()
+
+@pytest.fixture
+def context(fake_bot):
+    return SimpleNamespace(bot=fake_bot)
@@ -0,0 +1,52 @@
+import asyncio
+
+from telegram.error import BadRequest, Forbidden, RetryAfter
+
+import bot
+
+def test_concurrent_flood_errors_halve_the_rate_once(monkeypatch, fake_bot, tmp_path):
+    monkeypatch.setattr(bot, 'BROADCAST_STATE_FILE', str(tmp_path / 'broadcast.json'))
+    monkeypatch.setattr(bot, 'bot_data', bot.BotData(bot.JsonStorage(str(tmp_path / 'data.json'))))
+    for user_id in range(1, 31): bot.bot_data.add_user(user_id)
+    job = bot.BroadcastJob.create('hello', 1, 1)
+    job.limiter = bot.TokenBucket(1000, 1000)
+    monkeypatch.setattr(bot, 'BROADCAST_RATE', 1000)
+    fake_bot.latency = 0.01  # every sender is in flight when the burst is rejected
+    fake_bot.fail = [RetryAfter(0.05) for _ in range(bot.BROADCAST_CONCURRENCY)]
+    asyncio.run(job.run(fake_bot))
+    assert job.state['sent'] == 30
+    assert job.limiter.rate >= 500 - 0.1 * 30  # halved once for the whole burst, then creeping back up
+
+def test_failures_are_counted_in_state_and_metrics(monkeypatch, fake_bot, tmp_path):
+    monkeypatch.setattr(bot, 'BROADCAST_STATE_FILE', str(tmp_path / 'broadcast.json'))
+    monkeypatch.setattr(bot, 'bot_data', bot.BotData(bot.JsonStorage(str(tmp_path / 'data.json'))))
+    for user_id in (1, 2, 3, 4): bot.bot_data.add_user(user_id)
+    monkeypatch.setattr(bot, 'BROADCAST_CONCURRENCY', 1)
+    failed_before = bot.metrics.counters.get('broadcast_messages_total', {}).get((('result', 'failed'),), 0)
+    fake_bot.fail = [BadRequest('Message is too long'), Forbidden('bot was blocked by the user'), BadRequest('Chat not found')]
+    job = bot.BroadcastJob.create('hello', 1, 1)
+    asyncio.run(job.run(fake_bot))
+    assert (job.state['sent'], job.state['failed'], job.state['pruned']) == (1, 1, 2)
+    assert bot.metrics.counters['broadcast_messages_total'][(('result', 'failed'),)] == failed_before + 1
+    assert bot.bot_data.user_batch(None, 10) == [1, 4]
+
+def test_cancelled_job_saves_the_users_it_finished(monkeypatch, fake_bot, tmp_path):
+    monkeypatch.setattr(bot, 'BROADCAST_STATE_FILE', str(tmp_path / 'broadcast.json'))
+    monkeypatch.setattr(bot, 'bot_data', bot.BotData(bot.JsonStorage(str(tmp_path / 'data.json'))))
+    for user_id in range(1, 101): bot.bot_data.add_user(user_id)
+    monkeypatch.setattr(bot, 'BROADCAST_CONCURRENCY', 1)
+    monkeypatch.setattr(bot, 'BROADCAST_RATE', 1000)
+    fake_bot.latency = 0.002
+    async def scenario():
+        job = bot.BroadcastJob.create('hello', 1, 1)
+        task = asyncio.create_task(job.run(fake_bot))
+        while len(fake_bot.messages) < 10: await asyncio.sleep(0.001)
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+    asyncio.run(scenario())
+    state = bot.BroadcastJob.load().state
+    sent = [call[1] for call in fake_bot.calls if call[0] == 'send']
+    assert state['cursor'] == sent[-1] and state['done'] == len(sent)
+    resumed = bot.BroadcastJob.load()
+    asyncio.run(resumed.run(fake_bot))
+    assert sorted(call[1] for call in fake_bot.calls if call[0] == 'send') == list(range(1, 101))  # nobody got it twice
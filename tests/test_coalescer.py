@@ -0,0 +1,113 @@
+import asyncio
+from functools import partial
+
+import pytest
+
+import bot
+from bot import MessageCoalescer, ResponseCache
+
+from test_gemini import ScriptedModel
+
+class Answerer:
+    """Records every prompt it is asked to answer; each answer takes `delay` seconds."""
+    def __init__(self, delay=0.0, error=None):
+        self.delay, self.error, self.prompts, self.cancelled = delay, error, [], []
+    async def __call__(self, prompt: str):
+        self.prompts.append(prompt)
+        try: await asyncio.sleep(self.delay)
+        except asyncio.CancelledError:
+            self.cancelled.append(prompt); raise
+        if self.error: raise self.error
+        return prompt
+
+def test_burst_is_answered_once_with_every_message():
+    coalescer, answer = MessageCoalescer(0.05), Answerer()
+    async def scenario():
+        handlers = []
+        for text in ('one', 'two', 'three'):
+            handlers.append(asyncio.create_task(coalescer.submit(1, text, answer)))
+            await asyncio.sleep(0.01)
+        await asyncio.gather(*handlers)
+    asyncio.run(scenario())
+    assert answer.prompts == ['one\ntwo\nthree']
+    assert coalescer.coalesced == 2 and coalescer.chats == {}
+
+def test_newer_message_cancels_the_answer_and_is_answered_with_it():
+    coalescer, answer = MessageCoalescer(0.02), Answerer(delay=0.1)
+    async def scenario():
+        first = asyncio.create_task(coalescer.submit(1, 'one', answer))
+        await asyncio.sleep(0.05)  # past the window, so 'one' is being answered
+        await coalescer.submit(1, 'two', answer)
+        await first
+    asyncio.run(scenario())
+    assert answer.cancelled == ['one'] and answer.prompts == ['one', 'one\ntwo']
+    assert coalescer.cancelled == 1 and coalescer.chats == {}
+
+def test_failed_answer_clears_the_chat():
+    coalescer, answer = MessageCoalescer(0.01), Answerer(error=RuntimeError('boom'))
+    with pytest.raises(RuntimeError):
+        asyncio.run(coalescer.submit(1, 'one', answer))
+    assert coalescer.chats == {}
+    answer.error = None
+    asyncio.run(coalescer.submit(1, 'two', answer))
+    assert answer.prompts == ['one', 'two']  # the failed batch isn't resent
+
+def test_chats_are_coalesced_independently():
+    coalescer, answer = MessageCoalescer(0.02), Answerer()
+    async def scenario():
+        await asyncio.gather(coalescer.submit(1, 'a', answer), coalescer.submit(2, 'b', answer))
+    asyncio.run(scenario())
+    assert sorted(answer.prompts) == ['a', 'b'] and coalescer.cancelled == 0
+
+def test_waiter_takes_over_when_the_cache_producer_is_cancelled():
+    cache = ResponseCache(10, 60)
+    async def scenario():
+        owner = asyncio.create_task(cache.run('key', partial(Answerer(delay=1), 'from owner')))
+        await asyncio.sleep(0.01)
+        waiter = asyncio.create_task(cache.run('key', partial(Answerer(delay=0.01), 'from waiter')))
+        await asyncio.sleep(0.01)
+        owner.cancel()
+        return await waiter
+    # A cancelled owner used to hand None to its waiters, which then reported an API error
+    assert asyncio.run(scenario()) == ('from waiter', True)
+    assert cache.get('key') == 'from waiter'
+    assert (cache.hits, cache.misses, cache.coalesced) == (0, 2, 0)
+
+def test_waiters_share_a_finished_answer():
+    cache = ResponseCache(10, 60)
+    async def scenario():
+        return await asyncio.gather(cache.run('key', partial(Answerer(delay=0.02), 'answer')),
+                                    cache.run('key', partial(Answerer(), 'unused')))
+    assert asyncio.run(scenario()) == [('answer', True), ('answer', False)]
+    assert (cache.misses, cache.coalesced) == (1, 1)
+
+def test_cancelled_stream_deletes_its_partial_reply(monkeypatch, context, fake_bot):
+    monkeypatch.setattr(bot.gemini_client, 'model', ScriptedModel(['Half ', 'an ', 'answer'], delay=0.05))
+    async def scenario():
+        stream = asyncio.create_task(bot.stream_gemini_response(context, 1, 'question', 0))
+        while not fake_bot.messages: await asyncio.sleep(0.01)
+        stream.cancel()
+        with pytest.raises(asyncio.CancelledError): await stream
+    asyncio.run(scenario())
+    assert fake_bot.messages == {} and fake_bot.calls[-1][0] == 'delete'
+
+def test_waiters_get_the_producers_busy_error():
+    cache = ResponseCache(10, 60)
+    async def busy():
+        await asyncio.sleep(0.01)
+        raise bot.GeminiBusy()
+    async def scenario():
+        return await asyncio.gather(cache.run('key', busy), cache.run('key', partial(Answerer(), 'unused')), return_exceptions=True)
+    owner, waiter = asyncio.run(scenario())
+    assert isinstance(owner, bot.GeminiBusy) and isinstance(waiter, bot.GeminiBusy)
+
+def test_waiter_takes_over_when_the_producers_stream_broke_off():
+    cache = ResponseCache(10, 60)
+    async def broken():
+        await asyncio.sleep(0.01)
+        raise bot.IncompleteAnswer('half')
+    async def scenario():
+        return await asyncio.gather(cache.run('key', broken), cache.run('key', partial(Answerer(), 'whole')), return_exceptions=True)
+    owner, waiter = asyncio.run(scenario())
+    assert isinstance(owner, bot.IncompleteAnswer) and waiter == ('whole', True)
+    assert cache.get('key') == 'whole'
@@ -0,0 +1,135 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+from google.api_core import exceptions as google_exceptions
+from telegram.error import RetryAfter, TimedOut
+
+import bot
+
+def chunk(text: str):
+    return SimpleNamespace(parts=[text] if text else [], text=text, usage_metadata=None)
+
+class ScriptedModel:
+    """Streams the given texts, then raises `error` if one is set."""
+    def __init__(self, texts, error=None, delay=0.0):
+        self.texts, self.error, self.delay, self.calls = texts, error, delay, 0
+    async def generate_content_async(self, contents, stream=False, request_options=None):
+        self.calls += 1
+        async def chunks():
+            for text in self.texts:
+                await asyncio.sleep(self.delay)
+                yield chunk(text)
+            if self.error: raise self.error
+        return chunks()
+
+def test_partial_stream_is_shown_but_not_cached(monkeypatch, context, fake_bot):
+    monkeypatch.setattr(bot.gemini_client, 'model', ScriptedModel(['Partial answer'], google_exceptions.ServiceUnavailable('down')))
+    cache = bot.ResponseCache(10, 60)
+    async def produce(): return await bot.stream_gemini_response(context, 1, 'question', 0)
+    with pytest.raises(bot.IncompleteAnswer) as raised:
+        asyncio.run(cache.run('key', produce))
+    assert raised.value.text == 'Partial answer'
+    assert cache.get('key') is None
+    assert fake_bot.calls[-1][:3] in (('send', 1, 'Partial answer'), ('edit', 1, 'Partial answer'))
+
+def test_complete_stream_is_cached(monkeypatch, context):
+    monkeypatch.setattr(bot.gemini_client, 'model', ScriptedModel(['Full ', 'answer']))
+    cache = bot.ResponseCache(10, 60)
+    async def produce(): return await bot.stream_gemini_response(context, 1, 'question', 0)
+    assert asyncio.run(cache.run('key', produce)) == ('Full answer', True)
+    assert cache.get('key') == 'Full answer'
+
+def test_final_edit_waits_out_flood_control_without_a_gemini_slot(monkeypatch, context, fake_bot):
+    monkeypatch.setattr(bot.gemini_client, 'model', ScriptedModel(['Streamed ', 'answer'], delay=0.05))
+    async def scenario():
+        stream = asyncio.create_task(bot.stream_gemini_response(context, 1, 'question', 0))
+        while not fake_bot.calls: await asyncio.sleep(0.01)  # the first plain-text frame is out
+        fake_bot.fail = [RetryAfter(0.3)]  # the next edit hits flood control, so the final edit must wait
+        await asyncio.sleep(0.15)
+        assert not stream.done() and bot.gemini_scheduler.active == 0
+        return await stream
+    assert asyncio.run(scenario()) == 'Streamed answer'
+    assert fake_bot.calls[-1] == ('edit', 1, 'Streamed answer')
+
+def test_rollover_during_flood_control_keeps_parts_in_order(context, fake_bot):
+    async def scenario():
+        reply = bot.StreamingReply(context, 1, 0)
+        await reply.append('a' * 10)
+        fake_bot.fail = [RetryAfter(0.05)]
+        await reply.append('\n' + 'b' * (bot.MAX_MESSAGE_LENGTH - 5))  # rollover is held back, nothing waits
+        await reply.append('\nc')
+        await reply.finish()
+    asyncio.run(scenario())
+    final = {}
+    for call in fake_bot.calls: final[len(final) if call[0] == 'send' else len(final) - 1] = call[2]
+    assert [text[0] for text in final.values()] == ['a', 'b']
+    assert final[1].endswith('c') and len(final[1]) <= bot.MAX_MESSAGE_LENGTH
+
+class SlowFirstModel:
+    """The first stream stalls before its first chunk; later ones answer at once."""
+    def __init__(self): self.calls = 0
+    async def generate_content_async(self, contents, stream=False, request_options=None):
+        self.calls += 1
+        stall = 5.0 if self.calls == 1 else 0.0
+        async def chunks():
+            await asyncio.sleep(stall)
+            yield chunk(f'answer {self.calls}')
+        return chunks()
+
+def test_stream_is_hedged_before_its_first_chunk():
+    model = SlowFirstModel()
+    client = bot.GeminiClient(model, timeout=10, max_retries=0, base_delay=0, hedge_percentile=95)
+    client.first_chunk_latencies.extend([0.01] * 20)
+    async def collect(): return [c.text async for c in client.stream('question')]
+    started = bot.time.monotonic()
+    assert asyncio.run(collect()) == ['answer 2']
+    assert model.calls == 2 and bot.time.monotonic() - started < 1
+    assert len(client.first_chunk_latencies) == 21
+
+def test_stream_is_not_hedged_without_enough_samples():
+    model = ScriptedModel(['only'])
+    client = bot.GeminiClient(model, timeout=10, max_retries=0, base_delay=0, hedge_percentile=95)
+    async def collect(): return [c.text async for c in client.stream('question')]
+    assert asyncio.run(collect()) == ['only'] and model.calls == 1
+
+def test_failed_frame_is_skipped_and_the_stream_continues(monkeypatch, context, fake_bot):
+    monkeypatch.setattr(bot.gemini_client, 'model', ScriptedModel(['Part one ', 'part two ', 'part three'], delay=0.02))
+    async def scenario():
+        stream = asyncio.create_task(bot.stream_gemini_response(context, 1, 'question', 0))
+        while not fake_bot.calls: await asyncio.sleep(0.005)
+        fake_bot.fail = [TimedOut()]  # the second frame times out
+        return await stream
+    assert asyncio.run(scenario()) == 'Part one part two part three'
+    assert fake_bot.calls[-1] == ('edit', 1, 'Part one part two part three')
+
+class GatedModel:
+    """Every stream waits for `gate` before its first chunk, so hedged copies can finish together."""
+    def __init__(self):
+        self.calls, self.closed, self.gate = 0, [], asyncio.Event()
+        self.streams = []  # held like a client's open calls, so garbage collection can't close them for us
+    async def generate_content_async(self, contents, stream=False, request_options=None):
+        self.calls += 1
+        call = self.calls
+        async def chunks():
+            try:
+                await self.gate.wait()
+                yield chunk(f'answer {call}')
+            finally: self.closed.append(call)
+        self.streams.append(chunks())
+        return self.streams[-1]
+
+def test_hedged_stream_closes_the_copy_it_does_not_use():
+    model = GatedModel()
+    client = bot.GeminiClient(model, timeout=10, max_retries=0, base_delay=0, hedge_percentile=95)
+    client.first_chunk_latencies.extend([0.01] * 20)
+    async def scenario():
+        async def open_gate():
+            while model.calls < 2: await asyncio.sleep(0.005)
+            model.gate.set()  # both copies get their first chunk in the same round
+        gate = asyncio.create_task(open_gate())
+        texts = [c.text async for c in client.stream('question')]
+        await gate
+        return texts, sorted(model.closed)  # before asyncio.run's own cleanup closes leftover generators
+    texts, closed = asyncio.run(scenario())
+    assert len(texts) == 1 and model.calls == 2 and closed == [1, 2]
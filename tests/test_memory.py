@@ -0,0 +1,51 @@
+import pytest
+
+import bot
+from bot import BotData, ConversationMemory, JsonStorage
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(bot.time, 'time', lambda: now[0])
+    return now
+
+@pytest.fixture
+def storage(tmp_path, monkeypatch):
+    storage = JsonStorage(str(tmp_path / 'data.json'))
+    monkeypatch.setattr(bot, 'bot_data', BotData(storage))
+    return storage
+
+def test_expired_session_is_forgotten_and_deleted(clock, storage):
+    memory = ConversationMemory(1000, ttl=60, max_sessions=10, persist=True)
+    memory.record(1, 'hi', 'hello')
+    assert storage.get_history(1) is not None
+    clock[0] += 61
+    assert memory.contents(1, 'again') is None
+    assert 1 not in memory.sessions and storage.get_history(1) is None
+
+def test_reading_a_session_keeps_the_lru_head_oldest(clock, storage):
+    memory = ConversationMemory(1000, ttl=60, max_sessions=10, persist=False)
+    memory.record(1, 'a', 'b')
+    clock[0] += 30
+    memory.record(2, 'c', 'd')
+    clock[0] += 20
+    assert memory.contents(1, 'e') is not None  # touches session 1, which now sits behind session 2
+    clock[0] += 20
+    # Session 2 is idle for 40s and 1 for 20s; neither has expired, so both must survive eviction
+    memory.record(3, 'f', 'g')
+    assert list(memory.sessions) == [2, 1, 3]
+    clock[0] += 25
+    memory.record(3, 'h', 'i')
+    assert list(memory.sessions) == [1, 3]
+
+def test_sessions_pushed_out_by_capacity_stay_persisted(clock, storage):
+    memory = ConversationMemory(1000, ttl=60, max_sessions=1, persist=True)
+    memory.record(1, 'a', 'b')
+    memory.record(2, 'c', 'd')
+    assert list(memory.sessions) == [2] and storage.get_history(1) is not None
+    assert memory.contents(1, 'e') == [{'role': 'user', 'parts': ['a']}, {'role': 'model', 'parts': ['b']}, {'role': 'user', 'parts': ['e']}]
+
+def test_stale_persisted_history_is_deleted_on_lookup(clock, storage):
+    storage.set_history(1, {'last_used': clock[0] - 120, 'turns': [['user', 'a'], ['model', 'b']]})
+    memory = ConversationMemory(1000, ttl=60, max_sessions=10, persist=True)
+    assert memory.contents(1, 'c') is None and storage.get_history(1) is None
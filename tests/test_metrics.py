@@ -0,0 +1,64 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+import bot
+from bot import Histogram, Metrics
+
+from test_gemini import ScriptedModel
+
+def test_histogram_bucket_placement():
+    histogram = Histogram()
+    for value in (0.005, 0.0051, 0.3, 100.0): histogram.observe(value)
+    counts = dict(zip(bot.LATENCY_BUCKETS, histogram.counts))
+    assert counts[0.005] == 1 and counts[0.01] == 1 and counts[0.5] == 1  # upper bounds are inclusive
+    assert sum(histogram.counts) == 3 and histogram.count == 4  # 100s only shows up in +Inf
+    assert histogram.sum == pytest.approx(100.3101)
+
+def test_render_is_prometheus_text():
+    metrics = Metrics()
+    metrics.describe('requests_total', 'Requests.')
+    metrics.inc('requests_total', outcome='ok')
+    metrics.inc('requests_total', 2, outcome='bad "x"\n')
+    metrics.observe('latency_seconds', 0.02, mode='stream')
+    metrics.observe('latency_seconds', 7.0, mode='stream')
+    metrics.collect('queue_depth', 'gauge', 'Queued.', lambda: 3)
+    metrics.collect('broken', 'gauge', 'Fails.', lambda: 1 / 0)
+    lines = metrics.render().splitlines()
+    assert lines[:4] == ['# HELP requests_total Requests.', '# TYPE requests_total counter',
+                         'requests_total{outcome="ok"} 1', 'requests_total{outcome="bad \\"x\\"\\n"} 2']
+    assert '# TYPE latency_seconds histogram' in lines
+    assert 'latency_seconds_bucket{mode="stream",le="0.01"} 0' in lines
+    assert 'latency_seconds_bucket{mode="stream",le="0.025"} 1' in lines
+    assert 'latency_seconds_bucket{mode="stream",le="5.0"} 1' in lines
+    assert 'latency_seconds_bucket{mode="stream",le="10.0"} 2' in lines
+    assert 'latency_seconds_bucket{mode="stream",le="+Inf"} 2' in lines
+    assert 'latency_seconds_count{mode="stream"} 2' in lines
+    assert lines[-3:] == ['# HELP queue_depth Queued.', '# TYPE queue_depth gauge', 'queue_depth 3']
+
+def test_summary_reports_recent_percentiles():
+    metrics = Metrics()
+    for ms in range(1, 101): metrics.observe('call_seconds', ms / 1000, method='send')
+    metrics.observe('idle_seconds', 0.5)
+    assert metrics.summary() == ['call[send]: p50 50 · p95 95 · p99 99 ms (n=100)', 'idle: p50 500 · p95 500 · p99 500 ms (n=1)']
+
+def test_instrumented_records_latency_and_errors(monkeypatch):
+    metrics = Metrics()
+    monkeypatch.setattr(bot, 'metrics', metrics)
+    async def ok(update, context): return 'done'
+    async def broken(update, context): raise RuntimeError('boom')
+    assert asyncio.run(bot.instrumented('ok', ok)(None, None)) == 'done'
+    with pytest.raises(RuntimeError):
+        asyncio.run(bot.instrumented('broken', broken)(None, None))
+    assert metrics.counters['bot_handler_errors_total'] == {(('handler', 'broken'),): 1}
+    assert set(metrics.histograms['bot_handler_duration_seconds']) == {(('handler', 'ok'),), (('handler', 'broken'),)}
+
+def test_stream_duration_excludes_telegram_time(monkeypatch, context, fake_bot):
+    metrics = Metrics()
+    monkeypatch.setattr(bot, 'metrics', metrics)
+    monkeypatch.setattr(bot.gemini_client, 'model', ScriptedModel(['a ', 'b ', 'c'], delay=0.01))
+    fake_bot.latency = 0.1  # every send is slower than the whole Gemini stream
+    assert asyncio.run(bot.stream_gemini_response(context, 1, 'question', 0)) == 'a b c'
+    histogram = metrics.histograms['gemini_request_duration_seconds'][(('mode', 'stream'),)]
+    assert histogram.count == 1 and histogram.sum < 0.1
@@ -0,0 +1,131 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+import bot
+from bot import GeminiBusy, GeminiScheduler, KeyedRateLimiter
+
+def test_waiters_get_slots_by_priority_then_arrival():
+    scheduler, order = GeminiScheduler(1, 10), []
+    async def call(name: str, priority: int, hold: float = 0.01):
+        async with scheduler.slot(priority):
+            order.append(name)
+            await asyncio.sleep(hold)
+    async def scenario():
+        first = asyncio.create_task(call('running', 1, 0.05))
+        await asyncio.sleep(0)
+        waiters = [asyncio.create_task(call(name, priority)) for name, priority in (('group a', 1), ('private', 0), ('group b', 1))]
+        await asyncio.gather(first, *waiters)
+    asyncio.run(scenario())
+    assert order == ['running', 'private', 'group a', 'group b']
+    assert scheduler.active == 0 and scheduler.queue_depth == 0
+
+def test_full_queue_sheds_with_gemini_busy():
+    scheduler = GeminiScheduler(1, 1)
+    async def scenario():
+        release = asyncio.Event()
+        async def call():
+            async with scheduler.slot(): await release.wait()
+        running, queued = asyncio.create_task(call()), asyncio.create_task(call())
+        await asyncio.sleep(0)
+        with pytest.raises(GeminiBusy):
+            async with scheduler.slot(): pass
+        release.set()
+        await asyncio.gather(running, queued)
+    asyncio.run(scenario())
+    assert scheduler.rejected == 1 and scheduler.active == 0
+
+def test_cancelled_waiter_leaves_the_queue_and_frees_no_slot():
+    scheduler = GeminiScheduler(1, 10)
+    async def scenario():
+        release = asyncio.Event()
+        async def hold():
+            async with scheduler.slot(): await release.wait()
+        async def quick():
+            async with scheduler.slot(): return 'ran'
+        running = asyncio.create_task(hold())
+        await asyncio.sleep(0)
+        cancelled, later = asyncio.create_task(quick()), asyncio.create_task(quick())
+        await asyncio.sleep(0)
+        assert scheduler.queue_depth == 2
+        cancelled.cancel()
+        await asyncio.sleep(0)
+        assert scheduler.queue_depth == 1 and scheduler.active == 1
+        release.set()
+        return await later
+    assert asyncio.run(scenario()) == 'ran'
+    assert scheduler.active == 0 and scheduler.queue_depth == 0
+
+def test_waiter_cancelled_after_handover_passes_the_slot_on():
+    scheduler = GeminiScheduler(1, 10)
+    async def scenario():
+        async def quick():
+            async with scheduler.slot(): return 'ran'
+        slot = scheduler.slot()
+        await slot.__aenter__()
+        handed, later = asyncio.create_task(quick()), asyncio.create_task(quick())
+        await asyncio.sleep(0)
+        await slot.__aexit__(None, None, None)  # hands the slot to `handed`...
+        handed.cancel()  # ...which is cancelled before it runs
+        await asyncio.gather(handed, return_exceptions=True)
+        return await later
+    assert asyncio.run(scenario()) == 'ran'
+    assert scheduler.active == 0
+
+def test_drain_waits_for_running_calls_up_to_the_timeout():
+    scheduler = GeminiScheduler(2, 10)
+    async def scenario():
+        async def call(hold: float):
+            async with scheduler.slot(): await asyncio.sleep(hold)
+        short = asyncio.create_task(call(0.05))
+        await asyncio.sleep(0)
+        await scheduler.drain(1)
+        assert short.done()
+        long = asyncio.create_task(call(5))
+        await asyncio.sleep(0)
+        started = asyncio.get_running_loop().time()
+        await scheduler.drain(0.2)
+        assert not long.done() and asyncio.get_running_loop().time() - started < 1
+        long.cancel()
+    asyncio.run(scenario())
+
+def test_keyed_rate_limiter_bursts_refills_and_refunds(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(bot.time, 'monotonic', lambda: now[0])
+    limiter = KeyedRateLimiter(per_minute=60, burst=2)
+    assert [limiter.allow(1) for _ in range(3)] == [True, True, False]
+    assert limiter.allow(2)  # buckets are per key
+    now[0] += 1
+    assert limiter.allow(1) and not limiter.allow(1)
+    limiter.refund(1)
+    assert limiter.allow(1)
+
+def test_keyed_rate_limiter_forgets_least_recent_keys():
+    limiter = KeyedRateLimiter(per_minute=60, burst=1, max_keys=2)
+    for key in (1, 2, 1, 3): limiter.allow(key)
+    assert list(limiter.buckets) == [1, 3]
+
+def test_disabled_rate_limiter_always_allows():
+    limiter = KeyedRateLimiter(per_minute=0, burst=0)
+    assert all(limiter.allow(1) for _ in range(100)) and not limiter.buckets
+
+def group_update(user_id: int, chat_id: int):
+    return SimpleNamespace(effective_user=SimpleNamespace(id=user_id), effective_chat=SimpleNamespace(id=chat_id, type='supergroup'),
+                           message=SimpleNamespace(message_id=1))
+
+def test_group_rejection_does_not_charge_the_user(monkeypatch, context):
+    monkeypatch.setattr(bot, 'user_rate_limiter', KeyedRateLimiter(per_minute=1, burst=1))
+    monkeypatch.setattr(bot, 'group_rate_limiter', KeyedRateLimiter(per_minute=1, burst=0))
+    monkeypatch.setattr(bot, 'response_cache', bot.ResponseCache(10, 60))
+    assert asyncio.run(bot.answer_with_gemini(group_update(42, -1), context, 'question')) is None
+    assert bot.user_rate_limiter.allow(42)  # the user's only token is still there
+
+def test_cache_hits_are_not_rate_limited(monkeypatch, context, fake_bot):
+    monkeypatch.setattr(bot, 'user_rate_limiter', KeyedRateLimiter(per_minute=1, burst=0))
+    monkeypatch.setattr(bot, 'group_rate_limiter', KeyedRateLimiter(per_minute=0, burst=0))
+    cache = bot.ResponseCache(10, 60)
+    cache.put(bot.ResponseCache.make_key(bot.GEMINI_MODEL, 'question'), 'cached answer')
+    monkeypatch.setattr(bot, 'response_cache', cache)
+    assert asyncio.run(bot.answer_with_gemini(group_update(42, -1), context, 'question')) == 'cached answer'
+    assert ('send', -1, 'cached answer', bot.constants.ParseMode.MARKDOWN) in fake_bot.calls
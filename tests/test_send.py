@@ -0,0 +1,73 @@
+import asyncio
+
+import pytest
+from telegram.error import BadRequest, RetryAfter
+
+import bot
+
+PARSE_ERROR = "Can't parse entities: can't find end of the entity starting at byte offset 3"
+
+@pytest.fixture(autouse=True)
+def fast_pacer(monkeypatch):
+    monkeypatch.setattr(bot, 'chat_pacer', bot.ChatPacer(step=0.01))
+
+def test_plain_text_fallback_survives_two_floods(fake_bot):
+    fake_bot.fail = [RetryAfter(0.01), RetryAfter(0.01), BadRequest(PARSE_ERROR)]
+    message = asyncio.run(bot.send_paced(fake_bot, 1, 'a *b\nc* d'))
+    assert message is not None
+    assert fake_bot.calls == [('send', 1, 'a *b\nc* d', None)]
+
+def test_third_flood_is_raised(fake_bot):
+    fake_bot.fail = [RetryAfter(0.01), BadRequest(PARSE_ERROR), RetryAfter(0.01), RetryAfter(0.01)]
+    with pytest.raises(RetryAfter):
+        asyncio.run(bot.send_paced(fake_bot, 2, 'text'))
+    assert fake_bot.calls == []
+
+def test_other_bad_requests_are_raised(fake_bot):
+    fake_bot.fail = [BadRequest('Chat not found')]
+    with pytest.raises(BadRequest):
+        asyncio.run(bot.send_paced(fake_bot, 3, 'text'))
+
+def test_short_text_is_one_part():
+    assert bot.split_markdown('hello\nworld', 100) == ['hello\nworld']
+
+def test_parts_end_on_line_breaks_within_the_limit():
+    text = '\n'.join(f'line {i}' for i in range(100))
+    parts = bot.split_markdown(text, 50)
+    assert all(len(part) <= 50 for part in parts)
+    assert '\n'.join(parts) == text
+
+def test_code_block_is_closed_and_reopened_with_its_language():
+    text = 'intro\n```python\n' + '\n'.join(f'x = {i}' for i in range(30)) + '\n```\noutro'
+    parts = bot.split_markdown(text, 60)
+    assert len(parts) > 2 and all(len(part) <= 60 for part in parts)
+    for part in parts:
+        assert sum(line.startswith('```') for line in part.split('\n')) % 2 == 0
+    assert all(part.startswith('```python\n') for part in parts[1:-1])
+    assert parts[0].endswith('\n```') and parts[-1].endswith('outro')
+
+def test_long_line_is_cut_at_a_space_outside_spans():
+    text = ' '.join(['*bold words*'] * 20 + ['plain'] * 40)
+    parts = bot.split_markdown(text, 100)
+    assert all(len(part) <= 100 for part in parts)
+    for part in parts: assert part.count('*') % 2 == 0
+    assert ''.join(parts) == text
+
+def test_huge_single_line_keeps_every_character():
+    text = 'word ' * 200_000
+    parts = bot.split_markdown(text, bot.MAX_MESSAGE_LENGTH)
+    assert all(len(part) <= bot.MAX_MESSAGE_LENGTH for part in parts) and ''.join(parts) == text
+
+def test_span_across_lines_is_closed_and_reopened():
+    text = 'x' * 3990 + '\n*bold\nstill bold*'
+    parts = bot.split_markdown(text, 4000)
+    assert parts == ['x' * 3990 + '\n*bold*', '*still bold*']
+
+def test_long_language_tag_with_tiny_limit_terminates():
+    parts = bot.split_markdown('```' + 'p' * 37 + '\n' + 'z ' * 100 + '\n```', limit=40)
+    assert all(len(part) <= 40 for part in parts)
+    assert ''.join(parts).count('z') == 100
+
+def test_limit_too_small_for_a_code_block_is_rejected():
+    with pytest.raises(ValueError):
+        bot.split_markdown('x' * 20, 5)
@@ -0,0 +1,202 @@
+import json
+import asyncio
+
+import pytest
+
+import bot
+from bot import JsonStorage
+
+@pytest.fixture
+def data_file(tmp_path):
+    return str(tmp_path / 'data.json')
+
+def populate(storage: JsonStorage):
+    for user_id in (3, 1, 2): storage.add_user(user_id)
+    storage.set_user_language(1, 'bn')
+    storage.ban_user(2)
+    storage.add_group(-100)
+    storage.set_history(1, {'last_used': 1.0, 'turns': [['user', 'hi'], ['model', 'hello']]})
+
+def state(storage: JsonStorage) -> dict:
+    return {'users': list(storage.all_users), 'languages': storage.user_languages, 'banned': storage.banned_user_ids,
+            'groups': list(storage.authorized_group_ids), 'histories': storage.chat_histories}
+
+def test_flush_appends_log_that_replays_on_load(data_file):
+    storage = JsonStorage(data_file)
+    populate(storage)
+    asyncio.run(storage.flush())
+    assert storage._pending == []
+    reloaded = JsonStorage(data_file)
+    assert state(reloaded) == state(storage)
+    assert reloaded.get_user_language(1) == 'bn' and reloaded.is_user_banned(2) and reloaded.is_group_authorized(-100)
+
+def test_replay_applies_removals_in_order(data_file):
+    storage = JsonStorage(data_file)
+    populate(storage)
+    storage.remove_user(3)
+    storage.unban_user(2)
+    storage.remove_group(-100)
+    storage.delete_history(1)
+    asyncio.run(storage.flush())
+    reloaded = JsonStorage(data_file)
+    assert list(reloaded.all_users) == [1, 2]
+    assert not reloaded.banned_user_ids and not reloaded.authorized_group_ids and not reloaded.chat_histories
+
+def test_compact_writes_snapshot_and_truncates_log(data_file):
+    storage = JsonStorage(data_file)
+    populate(storage)
+    asyncio.run(storage.flush())
+    asyncio.run(storage.compact())
+    with open(data_file + '.log', encoding='utf-8') as f: assert f.read() == ''
+    with open(data_file, encoding='utf-8') as f: assert json.load(f) == storage.snapshot()
+    assert state(JsonStorage(data_file)) == state(storage)
+
+def test_changes_after_compaction_survive_reload(data_file):
+    storage = JsonStorage(data_file)
+    populate(storage)
+    asyncio.run(storage.compact())
+    storage.add_user(4)
+    storage.ban_user(4)
+    asyncio.run(storage.flush())
+    reloaded = JsonStorage(data_file)
+    assert list(reloaded.all_users) == [3, 1, 2, 4] and reloaded.is_user_banned(4)
+
+def test_compact_includes_unflushed_changes(data_file):
+    storage = JsonStorage(data_file)
+    populate(storage)
+    asyncio.run(storage.compact())
+    assert storage._pending == []
+    assert state(JsonStorage(data_file)) == state(storage)
+
+def test_failed_flush_requeues_records(data_file, monkeypatch):
+    storage = JsonStorage(data_file)
+    populate(storage)
+    queued = list(storage._pending)
+    def fail(lines): raise OSError('disk full')
+    monkeypatch.setattr(storage, '_append_log', fail)
+    asyncio.run(storage.flush())
+    assert storage._pending == queued
+    storage.add_user(5)  # newer records stay behind the re-queued ones
+    monkeypatch.undo()
+    asyncio.run(storage.flush())
+    assert list(JsonStorage(data_file).all_users) == [3, 1, 2, 5]
+
+def test_failed_compaction_requeues_records_and_keeps_log(data_file, monkeypatch):
+    storage = JsonStorage(data_file)
+    storage.add_user(1)
+    asyncio.run(storage.flush())
+    storage.add_user(2)
+    def fail(data): raise OSError('disk full')
+    monkeypatch.setattr(storage, '_write_snapshot', fail)
+    asyncio.run(storage.compact())
+    assert len(storage._pending) == 1
+    monkeypatch.undo()
+    asyncio.run(storage.flush())
+    assert list(JsonStorage(data_file).all_users) == [1, 2]
+
+def test_unreadable_log_records_are_skipped(data_file):
+    with open(data_file + '.log', 'w', encoding='utf-8') as f:
+        f.write('["add_user", 1]\nnot json\n["no_such_op", 2]\n["add_user", 3]\n')
+    assert list(JsonStorage(data_file).all_users) == [1, 3]
+
+def test_corrupt_snapshot_is_moved_aside(data_file):
+    with open(data_file, 'w', encoding='utf-8') as f: f.write('{"all_users": [1, 2')
+    storage = JsonStorage(data_file)
+    assert storage.count_users() == 0
+    with open(data_file + '.corrupt', encoding='utf-8') as f: assert f.read() == '{"all_users": [1, 2'
+    storage.add_user(7)
+    asyncio.run(storage.compact())
+    assert list(JsonStorage(data_file).all_users) == [7]
+    with open(data_file + '.corrupt', encoding='utf-8') as f: assert f.read() == '{"all_users": [1, 2'
+
+def test_snapshot_written_by_legacy_format_loads(data_file):
+    legacy = {'authorized_group_ids': [-5], 'banned_user_ids': [9], 'user_languages': {'8': 'bn'}, 'all_users': [8, 9]}
+    with open(data_file, 'w', encoding='utf-8') as f: json.dump(legacy, f)
+    storage = JsonStorage(data_file)
+    assert storage.get_user_language(8) == 'bn' and storage.is_user_banned(9) and storage.list_groups() == [-5]
+    assert storage.get_history(8) is None
+
+def test_sqlite_imports_json_once(data_file, tmp_path):
+    storage = JsonStorage(data_file)
+    populate(storage)
+    asyncio.run(storage.flush())
+    sqlite = bot.SqliteStorage(str(tmp_path / 'data.db'))
+    assert sqlite.import_json(data_file)
+    assert sqlite.count_users() == 3 and sqlite.get_user_language(1) == 'bn' and sqlite.is_user_banned(2)
+    assert sqlite.get_history(1) == storage.get_history(1)
+    assert not sqlite.import_json(data_file)
+    asyncio.run(sqlite.close())
+
+def test_sqlite_round_trip_and_checkpoint(tmp_path):
+    db_path = str(tmp_path / 'data.db')
+    sqlite = bot.SqliteStorage(db_path)
+    for user_id in range(1, 6): sqlite.add_user(user_id)
+    sqlite.ban_user(3)
+    asyncio.run(sqlite.compact())
+    assert sqlite.user_batch(2, 2) == [3, 4]
+    asyncio.run(sqlite.close())
+    wal = tmp_path / 'data.db-wal'
+    assert not wal.exists() or wal.stat().st_size == 0  # close checkpoints the WAL back into the database
+    reopened = bot.SqliteStorage(db_path)
+    assert reopened.count_users() == 5 and reopened.is_user_banned(3)
+    asyncio.run(reopened.close())
+
+def test_sqlite_lookups_do_not_wait_for_checkpoint(tmp_path, monkeypatch):
+    sqlite = bot.SqliteStorage(str(tmp_path / 'data.db'))
+    sqlite.add_user(1)
+    asyncio.run(sqlite.flush())
+    checkpoint_started, release = bot.threading.Event(), bot.threading.Event()
+    checkpoint = sqlite._checkpoint
+    def slow_checkpoint(mode):
+        checkpoint_started.set(); release.wait(5); checkpoint(mode)
+    monkeypatch.setattr(sqlite, '_checkpoint', slow_checkpoint)
+    async def scenario():
+        compaction = asyncio.create_task(sqlite.compact())
+        await asyncio.to_thread(checkpoint_started.wait, 5)
+        assert not sqlite._db_lock.locked()
+        assert not sqlite.is_user_banned(1) and sqlite.get_user_language(1) == 'en'
+        release.set()
+        await compaction
+    asyncio.run(scenario())
+    asyncio.run(sqlite.close())
+
+def test_user_batch_pages_in_id_order_through_changes(data_file):
+    storage = JsonStorage(data_file)
+    for user_id in (50, 10, 40, 20, 30): storage.add_user(user_id)
+    storage.remove_user(40)
+    storage.remove_user(99)
+    storage.add_user(10)
+    assert storage.user_batch(None, 2) == [10, 20]
+    assert storage.user_batch(20, 10) == [30, 50]
+    asyncio.run(storage.flush())
+    reloaded = JsonStorage(data_file)
+    reloaded.add_user(35)
+    assert reloaded.user_batch(20, 10) == [30, 35, 50]
+
+def test_expired_histories_are_dropped_before_compaction(data_file):
+    storage = JsonStorage(data_file)
+    storage.set_history(1, {'last_used': 100.0, 'turns': []})
+    storage.set_history(2, {'last_used': 300.0, 'turns': []})
+    assert asyncio.run(storage.expire_histories(200.0)) == 1
+    asyncio.run(storage.compact())
+    assert list(JsonStorage(data_file).chat_histories) == ['2']
+
+def test_sqlite_expires_histories(tmp_path):
+    sqlite = bot.SqliteStorage(str(tmp_path / 'data.db'))
+    sqlite.set_history(1, {'last_used': 100.0, 'turns': []})
+    sqlite.set_history(2, {'last_used': 300.0, 'turns': []})
+    assert asyncio.run(sqlite.expire_histories(200.0)) == 1
+    assert sqlite.get_history(1) is None and sqlite.get_history(2) is not None
+    asyncio.run(sqlite.close())
+
+def test_sqlite_commits_never_checkpoint(tmp_path):
+    sqlite = bot.SqliteStorage(str(tmp_path / 'data.db'))
+    # Only compact() checkpoints, on the maintenance connection; a commit holding _db_lock never does
+    assert sqlite.conn.execute('PRAGMA wal_autocheckpoint').fetchone()[0] == 0
+    asyncio.run(sqlite.close())
+
+def test_storage_backends_must_implement_the_interface():
+    class Partial(bot.Storage):
+        def add_user(self, user_id: int): pass
+    with pytest.raises(TypeError):
+        Partial()
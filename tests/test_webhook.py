@@ -0,0 +1,70 @@
+import json
+import asyncio
+
+import pytest
+
+import bot
+
+UPDATE = {'update_id': 1, 'message': {'message_id': 5, 'date': 0, 'chat': {'id': 42, 'type': 'private'},
+                                      'from': {'id': 42, 'is_bot': False, 'first_name': 'A'}, 'text': 'hi'}}
+
+def test_parse_update_accepts_an_update_object():
+    update = bot.parse_update(json.dumps(UPDATE).encode(), None)
+    assert update.update_id == 1 and update.message.text == 'hi'
+
+@pytest.mark.parametrize('body', [b'not json', b'[1, 2]', b'"update"', b'null', b'{}', b'{"update_id": "x", "message": 3}'])
+def test_parse_update_rejects_anything_else(body):
+    assert bot.parse_update(body, None) is None
+
+def test_webhook_mode_refuses_to_start_without_secret(monkeypatch):
+    monkeypatch.setenv('TELEGRAM_BOT_TOKEN', '1:test')
+    monkeypatch.setattr(bot, 'ADMIN_ID', 1)
+    monkeypatch.setattr(bot, 'BOT_MODE', 'webhook')
+    monkeypatch.setattr(bot, 'WEBHOOK_SECRET', '')
+    def build_application(token): raise AssertionError("the bot must not start")
+    monkeypatch.setattr(bot, 'build_application', build_application)
+    bot.main()
+
+def test_secret_check_rejects_non_ascii_tokens(monkeypatch):
+    monkeypatch.setattr(bot, 'WEBHOOK_SECRET', 's3cret')
+    assert bot.webhook_authorized({'x-telegram-bot-api-secret-token': 's3cret'})
+    assert not bot.webhook_authorized({'x-telegram-bot-api-secret-token': 'sécret'})
+    assert not bot.webhook_authorized({})
+
+async def request(server: bot.HttpServer, raw: bytes) -> bytes:
+    host, port = server.server.sockets[0].getsockname()[:2]
+    reader, writer = await asyncio.open_connection(host, port)
+    writer.write(raw)
+    response = await asyncio.wait_for(reader.read(), 2)
+    writer.close()
+    return response
+
+def serve(scenario):
+    async def run():
+        server = bot.HttpServer('127.0.0.1', 0)
+        async def ok(headers, body): return 200, 'text/plain', body or b'ok'
+        server.route('POST', '/hook', ok)
+        await server.start()
+        try: return await scenario(server)
+        finally: await server.stop()
+    return asyncio.run(run())
+
+def test_http_server_answers_a_request():
+    response = serve(lambda server: request(server, b'POST /hook HTTP/1.1\r\nContent-Length: 2\r\nConnection: close\r\n\r\nhi'))
+    assert response.startswith(b'HTTP/1.1 200 OK') and response.endswith(b'\r\n\r\nhi')
+
+def test_http_server_drops_slow_clients(monkeypatch):
+    monkeypatch.setattr(bot, 'HTTP_READ_TIMEOUT', 0.1)
+    async def scenario(server):
+        started = asyncio.get_running_loop().time()
+        response = await request(server, b'POST /hook HTTP/1.1\r\nContent-Len')  # never finishes its headers
+        return response, asyncio.get_running_loop().time() - started
+    response, elapsed = serve(scenario)
+    assert response == b'' and elapsed < 1
+
+def test_http_server_caps_headers(monkeypatch):
+    monkeypatch.setattr(bot, 'HTTP_MAX_HEADERS', 5)
+    headers = b''.join(b'X-%d: y\r\n' % i for i in range(10))
+    assert serve(lambda server: request(server, b'POST /hook HTTP/1.1\r\n' + headers + b'\r\n')) == b''
+    long_line = b'X-Long: ' + b'y' * (bot.HTTP_MAX_LINE + 1) + b'\r\n\r\n'
+    assert serve(lambda server: request(server, b'POST /hook HTTP/1.1\r\n' + long_line)) == b''